@@ -1,6 +1,5 @@
 import math
 import random
-import uuid
 import numpy as np
 from collections import defaultdict
 
@@ -22,17 +21,44 @@ angRanges = [22.5,67.5,112.5,157.5,202.5,247.5,292.5,337.5,400]
 sameDir = 20
 changeDir=50
 
+# Bit flags of Barn.cells
+OBSTACLE = 1
+CORRAL1 = 2
+CORRAL2 = 4
+COW = 8
+DOG = 16
+BLOCKED = OBSTACLE | COW | DOG
+
+
+def direction_kernels(rc, rcn):
+    """Unit vectors (x and y, shape (2, rc, rc)) from the centre of a rc x rc window
+    to each of its cells, zero at the centre, and the same kernels restricted to the
+    rcn x rcn neighbourhood."""
+    r = rc // 2
+    di, dj = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing="ij")
+    norm = np.hypot(di, dj)
+    norm[r, r] = 1
+    kernels = np.stack((di / norm, dj / norm))
+    near = (abs(di) <= rcn // 2) & (abs(dj) <= rcn // 2)
+    return kernels, kernels * near
+
 
 class Barn(mesa.Model):
 
-    def __init__(self, grid_width=50, grid_height=50,n_cows=30, n_team=5, corral_sz=5,n_obstacles=5):
+    def __init__(self, grid_width=50, grid_height=50,n_cows=30, n_team=5, corral_sz=5,n_obstacles=5, seed=None):
         mesa.Model.__init__(self)
+        # seed fixes the empty-cell weight, the placement of everything, the activation
+        # order and, through spawn_rng, the weights and moves of every cow and dog
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+        # Own scheduler stream: mesa's Model.__new__ puts one on the class, shared by every instance
+        self.random = random.Random(int(self.rng.integers(2 ** 63)))
         self.space = mesa.space.MultiGrid(grid_width, grid_height, False)
         self.schedule = RandomActivation(self)
 
         self.grid_width = grid_width
         self.grid_height = grid_height
-        self.weight_empty = random.randint(1,10)
+        self.weight_empty = int(self.rng.integers(1,11))
         self.weight_obstacle = -self.weight_empty
         self.obstacles = []
         self.teamCorral1 = []
@@ -47,39 +73,48 @@ class Barn(mesa.Model):
         self.center2x = grid_width//2
         self.center2y = 3*grid_height//4
         self.corral_sz = corral_sz
+        self.kernels = {}
+        # Occupancy of every cell as bit flags (terrain and agent), with the weight
+        # and unique_id of the agent standing there, indexed [x, y]
+        self.cells = np.zeros((grid_width, grid_height), dtype=np.uint8)
+        self.weights = np.zeros((grid_width, grid_height), dtype=np.int64)
+        self.ids = np.zeros((grid_width, grid_height), dtype=np.int64)
         for i in range(self.center1x-corral_sz//2,self.center1x+corral_sz//2+1):
             for j in range(self.center1y-corral_sz//2,self.center1y+corral_sz//2+1):
                 s.add((i,j))
                 self.teamCorral1.append((i,j))
+                self.cells[i, j] |= CORRAL1
         for i in range(self.center2x-corral_sz//2,self.center2x+corral_sz//2+1):
             for j in range(self.center2y-corral_sz//2,self.center2y+corral_sz//2+1):
                 s.add((i,j))
                 self.teamCorral2.append((i,j))
+                self.cells[i, j] |= CORRAL2
         for _ in range(n_obstacles):
-            x = int(random.random()* grid_width)
-            y= int(random.random() * grid_height)
+            x = int(self.rng.random()* grid_width)
+            y= int(self.rng.random() * grid_height)
             while((x,y) in s):
-                x = int(random.random()* grid_width)
-                y= int(random.random() * grid_height)
+                x = int(self.rng.random()* grid_width)
+                y= int(self.rng.random() * grid_height)
             s.add((x,y))
             self.obstacles.append((x,y))
+            self.cells[x, y] |= OBSTACLE
         for _ in range(n_cows):
-            x = int(random.random()* grid_width)
-            y= int(random.random() * grid_height)
+            x = int(self.rng.random()* grid_width)
+            y= int(self.rng.random() * grid_height)
             while((x,y) in s):
-                x = int(random.random()* grid_width)
-                y= int(random.random() * grid_height)
+                x = int(self.rng.random()* grid_width)
+                y= int(self.rng.random() * grid_height)
             s.add((x,y))
-            self.schedule.add(Cow(x, y, int(uuid.uuid1()), self))
+            self.add(Cow(x, y, self.next_id(), self))
         for _ in range(n_team):
             for j in range(1,3):
-                x = int(random.random()* grid_width)
-                y= int(random.random() * grid_height)
+                x = int(self.rng.random()* grid_width)
+                y= int(self.rng.random() * grid_height)
                 while((x,y) in s):
-                    x = int(random.random()* grid_width)
-                    y= int(random.random() * grid_height)
+                    x = int(self.rng.random()* grid_width)
+                    y= int(self.rng.random() * grid_height)
                 s.add((x,y))
-                self.schedule.add(Dog(x, y, int(uuid.uuid1()), self,j))
+                self.add(Dog(x, y, self.next_id(), self,j))
 
         self.dc = DataCollector({
             'Score1': lambda m : m.score1,
@@ -90,8 +125,81 @@ class Barn(mesa.Model):
         self.dc.collect(self)
 
 
+    def add(self, agent):
+        self.schedule.add(agent)
+        self.place(agent)
+
+    def place(self, agent):
+        x, y = agent.pos
+        self.cells[x, y] |= COW if isinstance(agent, Cow) else DOG
+        self.weights[x, y] = agent.weight
+        self.ids[x, y] = agent.unique_id
+
+    def unplace(self, agent):
+        x, y = agent.pos
+        self.cells[x, y] &= ~np.uint8(COW | DOG)
+        self.weights[x, y] = 0
+        self.ids[x, y] = 0
+
+    def move(self, agent, pos):
+        self.unplace(agent)
+        agent.pos = pos
+        self.place(agent)
+
+    def remove(self, agent):
+        self.unplace(agent)
+        self.schedule.remove(agent)
+
+    def window(self, pos, radius):
+        """Bounds (x0, x1, y0, y1) of the cells at Chebyshev distance <= radius of pos."""
+        return (max(pos[0] - radius, 0), min(pos[0] + radius + 1, self.grid_width),
+                max(pos[1] - radius, 0), min(pos[1] + radius + 1, self.grid_height))
+
+    def spawn_rng(self):
+        """Stream of one cow's or dog's weights and moves."""
+        return np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+    def flocking_directions(self, cows):
+        """Direction (index in dx/dy, -1 when the field vanishes) of the flocking field
+        at every cow, computed for all of them at once.
+
+        The field of a cow is the sum over its rc x rc window of the weight of each cell
+        times the unit vector towards it: obstacles -weight_empty, empty cells
+        weight_empty, dogs and far cows their weight, cows of the rcn x rcn
+        neighbourhood minus their weight. It is the correlation of two weight grids
+        with the direction kernels, evaluated at the cow cells; cells outside the grid
+        are zero padded."""
+        directions = np.full(len(cows), -1)
+        groups = defaultdict(list)
+        for k, cow in enumerate(cows):
+            groups[(cow.rc, cow.rcn)].append(k)
+        obstacle = (self.cells & OBSTACLE) != 0
+        agent = (self.cells & (COW | DOG)) != 0
+        far = np.where(obstacle, -self.weight_empty, np.where(agent, self.weights, self.weight_empty))
+        near = np.where(~obstacle & ((self.cells & COW) != 0), self.weights, 0)
+        for (rc, rcn), ks in groups.items():
+            if (rc, rcn) not in self.kernels:
+                self.kernels[(rc, rcn)] = direction_kernels(rc, rcn)
+            kernels, near_kernels = self.kernels[(rc, rcn)]
+            r = rc // 2
+            xs, ys = np.array([cows[k].pos for k in ks]).T
+            far_windows = np.lib.stride_tricks.sliding_window_view(np.pad(far, r), (rc, rc))[xs, ys]
+            near_windows = np.lib.stride_tricks.sliding_window_view(np.pad(near, r), (rc, rc))[xs, ys]
+            # A near cow weighs -weight instead of the +weight counted in far
+            v = np.einsum("nij,dij->nd", far_windows, kernels) - 2 * np.einsum("nij,dij->nd", near_windows, near_kernels)
+            ang = np.degrees(np.arctan2(v[:, 1], v[:, 0])) % 360
+            d = np.searchsorted(angRanges, ang) % 8
+            directions[ks] = np.where(np.hypot(v[:, 0], v[:, 1]) <= 1e-5, -1, d)
+        return directions
+
     def step(self):
         self.dc.collect(self)
+        # Cows play one tick out of three (Cow.turn): plan the moves of this tick's cows
+        # in one pass, against the state at the start of the tick
+        cows = [a for a in self.schedule.agents if isinstance(a, Cow) and (a.steps + 1) % 3 == a.turn]
+        if cows:
+            for cow, d in zip(cows, self.flocking_directions(cows).tolist()):
+                cow.direction = d
         self.schedule.step()
         if self.schedule.steps >= 1000:
             self.running = False
@@ -99,14 +207,16 @@ class Barn(mesa.Model):
 class Cow(mesa.Agent):
     def __init__(self, x, y, unique_id: int, model:Barn, rc = 9, rcn=3):
         super().__init__(unique_id, model)
+        self.rng = model.spawn_rng()
         self.pos = (x, y)
-        self.w = random.random()*10
+        self.w = self.rng.random()*10
         self.model = model
         self.rc = rc
         self.rcn = rcn
-        self.weight = random.randint(1,10)
-        self.turn = random.randint(0,2)
+        self.weight = int(self.rng.integers(1,11))
+        self.turn = int(self.rng.integers(0,3))
         self.steps = 0
+        self.direction = -1
     def portrayal_method(self):
         r = 0.5
         color = "black"
@@ -122,72 +232,22 @@ class Cow(mesa.Agent):
         self.steps%=3
         if(self.steps!=self.turn):
             return 
-        g = [[1 for i in range(self.rc)] for i in range(self.rc)]
-        rx = self.rc//2
-        ry = self.rc//2
-        for obj in self.model.schedule.agent_buffer():
-            x ,y = obj.pos
-            if(abs(x-self.pos[0])<=self.rc//2 and abs(y-self.pos[1])<=self.rc//2):
-                diffx = x-self.pos[0]
-                diffy = y-self.pos[1]
-                g[ry+diffy][rx+diffx]=obj
-        for (x,y)  in self.model.obstacles : 
-            if(abs(x-self.pos[0])<=self.rc//2 and abs(y-self.pos[1])<=self.rc//2):
-                diffx = x-self.pos[0]
-                diffy = y-self.pos[1]
-                g[ry+diffy][rx+diffx]=-1
-        middle = np.array((rx,ry))
-        v = np.zeros(2)
-        for i in range(self.rc):
-            for j in range(self.rc):
-                x = self.pos[0]-(rx-i)
-                y = self.pos[1]-(ry-j)
-                if(x<0 or x>=self.model.grid_width or y<0 or  y>=self.model.grid_height):
-                    continue
-                if i==rx and j==ry:
-                    continue
-                w=self.model.weight_empty
-                if(isinstance(g[j][i],Dog)):
-                    w=g[j][i].weight
-                    
-                elif isinstance(g[j][i],Cow) :
-                    if(abs(i-rx)<=self.rcn//2  and abs(j-ry)<=self.rcn//2):
-                        w  = -g[j][i].weight
-                    else : 
-                        w = g[j][i].weight
-                else :
-                    w*=g[j][i]
-                dif = (np.array((i,j))-middle)
-                
-                v+=w*dif/(np.linalg.norm(dif))
-
-        if(np.linalg.norm(v)<=1e-5):
+        d = self.direction
+        if d < 0:
             return
-        
-        v = v/np.linalg.norm(v)
-        ang = np.angle(complex(v[0],v[1]))
-        ang=ang*180/math.pi
-        if(ang<0):
-            ang=360+ang
-        d = 0
-        for i in range(len(angRanges)):
-            if ang<=angRanges[i]:
-                d=i%8
-                break
-        ni = rx+dx[d]
-        nj = ry+dy[d]
         nx = self.pos[0]+dx[d]
         ny = self.pos[1]+dy[d]
         if nx>=0 and nx<self.model.grid_width and ny>=0 and  ny<self.model.grid_height:
-            if(isinstance(g[nj][ni],int) and g[nj][ni]==1):
-                if((nx,ny) in self.model.teamCorral1):
+            cell = self.model.cells[nx, ny]
+            if not cell & BLOCKED:
+                if cell & CORRAL1:
                     self.model.score1+=1
-                    self.model.schedule.remove(self)
-                elif ((nx,ny) in self.model.teamCorral2): 
+                    self.model.remove(self)
+                elif cell & CORRAL2: 
                     self.model.score2+=1
-                    self.model.schedule.remove(self)
+                    self.model.remove(self)
                 else : 
-                    self.pos=(nx,ny)
+                    self.model.move(self, (nx,ny))
 
 
 
@@ -198,12 +258,13 @@ class Cow(mesa.Agent):
 class Dog(mesa.Agent):
     def __init__(self, x, y, unique_id: int, model:Barn, type: int, visibility = 17):
         super().__init__(unique_id, model)
+        self.rng = model.spawn_rng()
         self.pos = (x, y)
-        self.w = random.random()*20
+        self.w = self.rng.random()*20
         self.type = type
         self.model = model
         self.visibility = visibility
-        self.weight = random.randint(-300,-100)
+        self.weight = int(self.rng.integers(-300,-99))
 
     def portrayal_method(self):
         r = 0.8
@@ -229,23 +290,23 @@ class Dog(mesa.Agent):
 
             to_Cor =to_Cor/np.linalg.norm(to_Cor)
             v = np.zeros(2)
-            for obj in self.model.schedule.agent_buffer():
-                if(isinstance(obj, Cow)):
-                    x ,y = obj.pos
-                    if(abs(x-self.pos[0])<=self.visibility//2 and abs(y-self.pos[1])<=self.visibility//2):
-                        to_Cow = (np.array((x, y))-np.array(self.pos)).astype(float)
-                    else :
-                        continue
-                    to_Cow /=np.linalg.norm(to_Cow)
-                    dot = np.sum(to_Cor*to_Cow)
-                    ang = np.arccos(dot)
-                    ang=ang*180/math.pi
-                    if(ang<mnang):
-                        mnang=ang
-                        cow = obj
+            x0, x1, y0, y1 = self.model.window(self.pos, self.visibility//2)
+            xs, ys = np.nonzero(self.model.cells[x0:x1, y0:y1] & COW)
+            xs += x0
+            ys += y0
+            # same order as the schedule: by unique_id
+            order = np.argsort(self.model.ids[xs, ys], kind="stable")
+            for x, y in zip(xs[order].tolist(), ys[order].tolist()):
+                to_Cow = (np.array((x, y))-np.array(self.pos)).astype(float)
+                to_Cow /=np.linalg.norm(to_Cow)
+                dot = np.sum(to_Cor*to_Cow)
+                ang = np.arccos(dot)
+                ang=ang*180/math.pi
+                if(ang<mnang):
+                    mnang=ang
+                    cow = (x, y)
         if(cow is not None):
-            x = cow.pos[0]
-            y =  cow.pos[1]
+            x, y = cow
             if(mnang<=sameDir):
                 v = np.array((x,y)-np.array(self.pos))
                 v = v/np.linalg.norm(v)
@@ -261,19 +322,13 @@ class Dog(mesa.Agent):
                 nx = self.pos[0]+dx[d]
                 ny = self.pos[1]+dy[d]
                 if nx>=0 and nx<self.model.grid_width and ny>=0 and  ny<self.model.grid_height:
-                    npos = (nx,ny)
-                    if(npos in self.model.obstacles):
+                    if(self.model.cells[nx, ny] & OBSTACLE):
                         cow=None
-                    cond=True
-                    for obj in self.model.schedule.agent_buffer():
-                        if(obj.pos[0]==nx and obj.pos[1]==ny):
-                            cond=False
-                            break
-                    if(cond):
-                        self.pos=(nx,ny)
+                    if not self.model.cells[nx, ny] & (COW | DOG):
+                        self.model.move(self, (nx,ny))
             elif(mnang<=changeDir):
                 v = np.array((-to_Cor[1], to_Cor[0]))
-                to_Cow = np.array((cow.pos))-np.array(self.pos)
+                to_Cow = np.array((cow))-np.array(self.pos)
                 det = to_Cor[0]*to_Cow[1] - to_Cor[1]*to_Cow[0]
                 if(det<0):
                     v*=-1
@@ -290,35 +345,23 @@ class Dog(mesa.Agent):
                 nx = self.pos[0]+dx[d]
                 ny = self.pos[1]+dy[d]
                 if nx>=0 and nx<self.model.grid_width and ny>=0 and  ny<self.model.grid_height:
-                    npos = (nx,ny)
-                    if(npos in self.model.obstacles):
+                    if(self.model.cells[nx, ny] & OBSTACLE):
                         cow=None
-                    cond=True
-                    for obj in self.model.schedule.agent_buffer():
-                        if(obj.pos[0]==nx and obj.pos[1]==ny):
-                            cond=False
-                            break
-                    if(cond):
-                        self.pos=(nx,ny)
+                    if not self.model.cells[nx, ny] & (COW | DOG):
+                        self.model.move(self, (nx,ny))
 
             else : 
                 cow=None
 
         if( cow is None):
-            d = random.randint(0,7)
+            d = int(self.rng.integers(0,8))
             nx = self.pos[0]+dx[d]
             ny = self.pos[1]+dy[d]
             if nx>=0 and nx<self.model.grid_width and ny>=0 and  ny<self.model.grid_height:
-                npos = (nx,ny)
-                if(npos in self.model.obstacles):
+                if(self.model.cells[nx, ny] & OBSTACLE):
                     return
-                cond=True
-                for obj in self.model.schedule.agent_buffer():
-                    if(obj.pos[0]==nx and obj.pos[1]==ny):
-                        cond=False
-                        break
-                if(cond):
-                    self.pos=(nx,ny)
+                if not self.model.cells[nx, ny] & (COW | DOG):
+                    self.model.move(self, (nx,ny))
         
 
 
@@ -4,15 +4,15 @@ var ContinuousVisualization = function(height, width, context) {
 	var context = context;
     context.transform(1, 0, 0, -1, 0, height);
 
-	this.draw = function(objects) {
-		for (var i in objects) {
-			var l = objects[i];
-			for (var j in l){
-			    var p = l[j]
-                if (p.Shape == "circle")
-                    this.drawCircle(p.x, p.y, p.r, p.Color, p.Filled);
-    		};
-		};
+	// portrayals: list already ordered by layer
+	this.draw = function(portrayals) {
+		for (var i = 0; i < portrayals.length; i++)
+			this.drawPortrayal(portrayals[i]);
+	};
+
+	this.drawPortrayal = function(p) {
+        if (p.Shape == "circle")
+            this.drawCircle(p.x, p.y, p.r, p.Color, p.Filled);
 	};
 
 	this.drawCircle = function(x, y, radius, color, fill) {
@@ -39,6 +39,71 @@ var ContinuousVisualization = function(height, width, context) {
 	};
 };
 
+// Scene rebuilt from the frames of ContinuousCanvas.render. Frames hold columnar
+// groups {template, ids, columns}: a keyframe replaces the scene (its groups may come
+// without ids, then the next frame is a keyframe too), the other frames only add,
+// update or remove agents by id
+var FrameState = function() {
+	this.reset = function() {
+		this.templates = {};
+		this.fixed = [];  // static groups, sent with the keyframes
+		this.groups = [];  // groups of the last keyframe sent without ids
+		this.entities = {};  // id -> [template id, values...]
+	};
+	this.reset();
+
+	this.apply = function(frame) {
+		if (frame.key) {
+			this.fixed = frame.static;
+			this.groups = [];
+			this.entities = {};
+		}
+		Object.assign(this.templates, frame.templates);
+		for (var i = 0; i < frame.remove.length; i++)
+			delete this.entities[frame.remove[i]];
+		for (var i = 0; i < frame.update.length; i++) {
+			var group = frame.update[i];
+			if (!group.ids) {
+				this.groups.push(group);
+				continue;
+			}
+			var columns = this.templates[group.template].columns;
+			for (var k = 0; k < group.ids.length; k++) {
+				var row = [group.template];
+				for (var c = 0; c < columns.length; c++)
+					row.push(group.columns[columns[c]][k]);
+				this.entities[group.ids[k]] = row;
+			}
+		}
+	};
+
+	// Portrayals of the scene ordered by layer
+	this.portrayals = function() {
+		var templates = this.templates;
+		var layers = {};
+		var add = function(template, value) {
+			var p = Object.assign({}, template.portrayal);
+			for (var c = 0; c < template.columns.length; c++)
+				p[template.columns[c]] = value(c);
+			(layers[p.Layer] = layers[p.Layer] || []).push(p);
+		};
+		this.fixed.concat(this.groups).forEach(function(group) {
+			var template = templates[group.template];
+			var n = group.columns[template.columns[0]].length;
+			for (var k = 0; k < n; k++)
+				add(template, function(c) { return group.columns[template.columns[c]][k]; });
+		});
+		Object.values(this.entities).forEach(function(row) {
+			add(templates[row[0]], function(c) { return row[1 + c]; });
+		});
+		var result = [];
+		Object.keys(layers).sort(function(a, b) { return a - b; }).forEach(function(l) {
+			result = result.concat(layers[l]);
+		});
+		return result;
+	};
+};
+
 var Simple_Continuous_Module = function(canvas_width, canvas_height, ids) {
 	// Create the element
 	// ------------------
@@ -53,13 +118,16 @@ var Simple_Continuous_Module = function(canvas_width, canvas_height, ids) {
 	// Create the context and the drawing controller:
 	var context = canvas.getContext("2d");
 	var canvasDraw = new ContinuousVisualization(canvas_width, canvas_height, context);
+	var scene = new FrameState();
 
 	this.render = function(data) {
+		scene.apply(data);
 		canvasDraw.resetCanvas();
-		canvasDraw.draw(data);
+		canvasDraw.draw(scene.portrayals());
 	};
 
 	this.reset = function() {
+		scene.reset();
 		canvasDraw.resetCanvas();
 	};
 
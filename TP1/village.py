@@ -1,131 +1,157 @@
+import argparse
+import csv
+import itertools
 import math
 import random
+import os
 import numpy as np
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import uuid
 import mesa
 import numpy
 import pandas
 from mesa import space
-from mesa.batchrunner import BatchRunner
 from mesa.datacollection import DataCollector
 from mesa.time import RandomActivation
-from mesa.visualization.ModularVisualization import ModularServer, VisualizationElement, UserSettableParameter
-from mesa.visualization.modules import ChartModule
-
-class ContinuousCanvas(VisualizationElement):
-    local_includes = [
-        "./js/simple_continuous_canvas.js",
-    ]
-
-    def __init__(self, canvas_height=500,
-                 canvas_width=500, instantiate=True):
-        self.canvas_height = canvas_height
-        self.canvas_width = canvas_width
-        self.identifier = "space-canvas"
-        if (instantiate):
-            new_element = ("new Simple_Continuous_Module({}, {},'{}')".
-                           format(self.canvas_width, self.canvas_height, self.identifier))
-            self.js_code = "elements.push(" + new_element + ");"
-
-    def portrayal_method(self, obj):
-        return obj.portrayal_method()
-
-    def render(self, model):
-        representation = defaultdict(list)
-        for obj in model.schedule.agents:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.pos[0] - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.pos[1] - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        return representation
-
-class ChartModule(VisualizationElement):
-
-    local_includes = [
-        "./js/ChartModule.js",
-        "./js/chart.min.js"
-    ]
-
-    def __init__(
-        self,
-        series,
-        canvas_height=400,
-        canvas_width=800,
-        data_collector_name="data_collector",
-    ):
-
-        self.series = series
-        self.canvas_height = canvas_height
-        self.canvas_width = canvas_width
-        self.data_collector_name = data_collector_name
-        #series_json = json.dumps(self.series)
-        new_element = ("new ChartModule({}, {},'{}')".
-                           format(self.series, self.canvas_width, self.canvas_height))
-        self.js_code = "elements.push(" + new_element + ");"
-        
-        #new_element = "new ChartModule({}, {},  {})"
-        #new_element = new_element.format(series_json, canvas_width, canvas_height)
-        #self.js_code = "elements.push(" + new_element + ");"
-
-    
-    def render(self, model):
-        current_values = []
-        data_collector = getattr(model, self.data_collector_name)
-        data_collector.collect(model)
-        
-        for s in self.series:
-            name = s["Label"]
-            try:
-                val = data_collector.model_vars[name][-1]  # Latest value
-
-            except (IndexError, KeyError):
-                val = 0
-            current_values.append(val)
-        return current_values
-
-def wander(x, y, speed, model):
-    r = random.random() * math.pi * 2
+
+class SpatialHashGrid:
+    """Uniform grid bucketing agents by position for radius queries.
+
+    Cells are keyed by integer coordinates and hold agents in insertion order,
+    so a query only visits the cells overlapping the search disc.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.cell_of = {}
+
+    def _cell(self, pos):
+        return int(pos[0] // self.cell_size), int(pos[1] // self.cell_size)
+
+    def add(self, agent):
+        cell = self._cell(agent.pos)
+        self.cells[cell][agent] = None
+        self.cell_of[agent] = cell
+
+    def remove(self, agent):
+        cell = self.cell_of.pop(agent)
+        bucket = self.cells[cell]
+        del bucket[agent]
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, agent, pos):
+        agent.pos = pos
+        cell = self._cell(pos)
+        old = self.cell_of[agent]
+        if cell != old:
+            bucket = self.cells[old]
+            del bucket[agent]
+            if not bucket:
+                del self.cells[old]
+            self.cells[cell][agent] = None
+            self.cell_of[agent] = cell
+
+    def query(self, pos, radius):
+        x, y = pos
+        r2 = radius * radius
+        cx_min, cy_min = self._cell((x - radius, y - radius))
+        cx_max, cy_max = self._cell((x + radius, y + radius))
+        found = []
+        for cx in range(cx_min, cx_max + 1):
+            for cy in range(cy_min, cy_max + 1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for agent in bucket:
+                    dx = agent.pos[0] - x
+                    dy = agent.pos[1] - y
+                    if dx * dx + dy * dy <= r2:
+                        found.append(agent)
+        return found
+
+
+def wander(x, y, speed, model, rng):
+    r = rng.random() * math.pi * 2
     new_x = max(min(x + math.cos(r) * speed, model.space.x_max), model.space.x_min)
     new_y = max(min(y + math.sin(r) * speed, model.space.y_max), model.space.y_min)
 
     return new_x, new_y
 
 class  Village(mesa.Model):
-    def  __init__(self,  n_villagers, n_lycanthropes, n_clerics, n_hunters):
+    def  __init__(self,  n_villagers, n_lycanthropes, n_clerics, n_hunters, seed=None):
         mesa.Model.__init__(self)
+        # seed fixes the placement of the villagers, the activation order and, through
+        # spawn_rng, the wandering, transformations and attacks of every agent
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+        # Own scheduler stream: mesa's Model.__new__ puts one on the class, shared by every instance
+        self.random = random.Random(int(self.rng.integers(2 ** 63)))
         self.space = mesa.space.ContinuousSpace(600, 600, False)
         self.schedule = RandomActivation(self)
-        self.villagers = []
-        self.wolfs = []
-        self.clerics = []
-        self.hunters = []
+        # Role membership sets, kept in sync by infect/cure/transform/kill
+        self.villagers = set()
+        self.wolfs = set()
+        self.clerics = set()
+        self.hunters = set()
+        self.n_transformed = 0
         
-        self.data_collector =  DataCollector({"Werewolves": lambda m: len([i for i in m.wolfs if not i.transformed]),
-                                "Transformed": lambda m: len([i for i in m.wolfs if i.transformed]),
+        self.data_collector =  DataCollector({"Werewolves": lambda m: len(m.wolfs) - m.n_transformed,
+                                "Transformed": lambda m: m.n_transformed,
                                 "Total": lambda m: m.schedule.get_agent_count(),
                                 "Population": lambda m: m.schedule.get_agent_count()-len(m.wolfs)})
         
         for  _  in  range(n_villagers+n_lycanthropes+n_clerics+n_hunters):
             if _ < n_villagers:
-                self.villagers.append(Villager(random.random()  *  600,  random.random()  *  600,  10, _, self))
-                self.schedule.add(self.villagers[-1])
+                agent = Villager(*(self.rng.random(2)  *  600).tolist(),  10, self.next_id(), self)
+                self.villagers.add(agent)
                 
             elif _ < n_villagers + n_lycanthropes:
-                self.wolfs.append(Villager(random.random()  *  600,  random.random()  *  600,  10, _, self, wolf=True))
-                self.schedule.add(self.wolfs[-1])
+                agent = Villager(*(self.rng.random(2)  *  600).tolist(),  10, self.next_id(), self, wolf=True)
+                self.wolfs.add(agent)
 
             elif _ < n_villagers + n_lycanthropes + n_clerics:
 
-                self.clerics.append(Cleric(random.random()  *  600,  random.random()  *  600,  10, _, self))
-                self.schedule.add(self.clerics[-1])
+                agent = Cleric(*(self.rng.random(2)  *  600).tolist(),  10, self.next_id(), self)
+                self.clerics.add(agent)
             else:
-                self.hunters.append(Hunter(random.random()  *  600,  random.random()  *  600,  10, _, self))
-                self.schedule.add(self.hunters[-1])
+                agent = Hunter(*(self.rng.random(2)  *  600).tolist(),  10, self.next_id(), self)
+                self.hunters.add(agent)
+            self.schedule.add(agent)
+
+        # Cell size tied to the largest attack distance so a query touches at most 3x3 cells
+        self.grid = SpatialHashGrid(max([a.distance_attack for a in self.schedule.agents], default=40))
+        for agent in self.schedule.agents:
+            self.grid.add(agent)
+
+
+    def infect(self, agent):
+        agent.wolf = True
+        self.villagers.discard(agent)
+        self.wolfs.add(agent)
+
+    def cure(self, agent):
+        agent.wolf = False
+        self.wolfs.discard(agent)
+        self.villagers.add(agent)
+
+    def transform(self, agent):
+        if not agent.transformed:
+            agent.transformed = True
+            self.n_transformed += 1
+
+    def spawn_rng(self):
+        """Stream of one agent's moves and rolls."""
+        return np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+    def kill(self, agent):
+        if agent.transformed:
+            self.n_transformed -= 1
+        self.wolfs.discard(agent)
+        self.schedule.remove(agent)
+        self.grid.remove(agent)
   
     def step(self):
         self.schedule.step()
@@ -141,7 +167,11 @@ class Villager(mesa.Agent):
         self.distance_attack = distance_attack
         self.p_attack = p_attack
         self.wolf = wolf
+        self.rng = model.spawn_rng()
         self.transformed = False
+
+    def portrayal_state(self):
+        return self.wolf, self.transformed
         
     def portrayal_method(self):
         color = "red" if self.wolf else "blue"
@@ -154,22 +184,15 @@ class Villager(mesa.Agent):
         return portrayal
 
     def step(self):
-        if self.wolf and random.random() <= 0.1:
-            self.transformed = True
+        if self.wolf and self.rng.random() <= 0.1:
+            self.model.transform(self)
 
         if self.wolf:
-            rem = []
-            for agent in self.model.villagers:
-                dist = math.sqrt((agent.pos[0] - self.pos[0])**2 + (agent.pos[1] - self.pos[1])**2)
-                if dist <= self.distance_attack:
-                    agent.wolf = True
-                    self.model.wolfs.append(agent)
-                    rem.append(agent)
+            for agent in self.model.grid.query(self.pos, self.distance_attack):
+                if isinstance(agent, Villager) and not agent.wolf:
+                    self.model.infect(agent)
                     
-            for agent in rem:
-                self.model.villagers.remove(agent)
-                    
-        self.pos = wander(self.pos[0], self.pos[1], self.speed, self.model)
+        self.model.grid.move(self, wander(self.pos[0], self.pos[1], self.speed, self.model, self.rng))
 
 class Cleric(mesa.Agent):
     def __init__(self, x, y, speed, unique_id: int, model: Village, distance_attack=30, p_attack=0.6):
@@ -179,6 +202,10 @@ class Cleric(mesa.Agent):
         self.model = model
         self.distance_attack = distance_attack
         self.p_attack = p_attack
+        self.rng = model.spawn_rng()
+
+    def portrayal_state(self):
+        return None
         
     def portrayal_method(self):
         color = "green"
@@ -191,21 +218,13 @@ class Cleric(mesa.Agent):
         return portrayal
 
     def step(self):
-        rem = []
-        for agent in self.model.wolfs:
-            if agent.transformed:
+        for agent in self.model.grid.query(self.pos, self.distance_attack):
+            if not isinstance(agent, Villager) or not agent.wolf or agent.transformed:
                 continue
-            dist = math.sqrt((agent.pos[0] - self.pos[0])**2 + (agent.pos[1] - self.pos[1])**2)
-            if dist <= self.distance_attack:
-                agent.wolf = False
-                self.model.villagers.append(agent)
-                rem.append(agent)
-
-        for agent in rem:
-            self.model.wolfs.remove(agent)
+            self.model.cure(agent)
             
             
-        self.pos = wander(self.pos[0], self.pos[1], self.speed, self.model)
+        self.model.grid.move(self, wander(self.pos[0], self.pos[1], self.speed, self.model, self.rng))
 
 class Hunter(mesa.Agent):
     def __init__(self, x, y, speed, unique_id: int, model: Village, distance_attack=40, p_attack=0.6):
@@ -215,6 +234,10 @@ class Hunter(mesa.Agent):
         self.model = model
         self.distance_attack = distance_attack
         self.p_attack = p_attack
+        self.rng = model.spawn_rng()
+
+    def portrayal_state(self):
+        return None
         
     def portrayal_method(self):
         color = "black"
@@ -227,47 +250,247 @@ class Hunter(mesa.Agent):
         return portrayal
 
     def step(self):
-        rem = []
-        for agent in self.model.wolfs:
-            if not agent.transformed:
-                continue
-            dist = math.sqrt((agent.pos[0] - self.pos[0])**2 + (agent.pos[1] - self.pos[1])**2)
-            if dist <= self.distance_attack:
-                rem.append(agent)
-
-        for agent in rem:
-            self.model.wolfs.remove(agent)
-            self.model.schedule.remove(agent)
+        for agent in self.model.grid.query(self.pos, self.distance_attack):
+            if isinstance(agent, Villager) and agent.wolf and agent.transformed:
+                self.model.kill(agent)
             
-        self.pos = wander(self.pos[0], self.pos[1], self.speed, self.model)
-
-
-def run_single_server():
-    server  =  ModularServer(Village, [ContinuousCanvas(), ChartModule([{"Label": "Population", "Color": "Orange"},
-                                                                        {"Label": "Werewolves", "Color": "Red"},
-                                                                        {"Label": "Transformed", "Color": "Brown"},
-                                                                        {"Label": "Total", "Color": "black"}])],
-                                                                    "Village",{"n_villagers":  UserSettableParameter('slider', "Villagers", 20, 10, 100, 1),
-                                                                      "n_lycanthropes": UserSettableParameter('slider', "Werwolves", 5, 3, 50, 1),
-                                                                      "n_clerics": UserSettableParameter('slider', "Clerics", 1, 1, 50, 1),
-                                                                      "n_hunters": UserSettableParameter('slider', "Hunters", 2, 1, 50, 1)})
-    server.port = 8521
-    server.launch()
-
-
-def run_batch():
-    params = {"n_villagers":  [50],
-            "n_lycanthropes": [5],
-            "n_clerics": range(0, 6, 1),
-            "n_hunters": [1]}
-
-    batchrunner = BatchRunner(Village, params, model_reporters={"n_villagers": lambda m: len(m.villagers),
-                                "n_lycanthropes": lambda m: len(m.wolfs),
-                                "n_clerics": lambda m: len(m.clerics),
-                                "n_hunters": lambda m: len(m.hunters)})
-    batchrunner.port = 8521
-    batchrunner.run_all()
-    df = batchrunner.get_model_vars_dataframe()
-    df.to_csv('params.csv')
+        self.model.grid.move(self, wander(self.pos[0], self.pos[1], self.speed, self.model, self.rng))
+
+
+ROLE_VILLAGER, ROLE_WOLF, ROLE_TRANSFORMED, ROLE_CLERIC, ROLE_HUNTER = range(5)
+
+
+def any_within(src, dst, radius, height=600):
+    """For each point of dst, whether some point of src is closer than radius.
+
+    Sources are bucketed on a grid of cell size radius and sorted by cell key.
+    Each target walks the sources of the 3x3 block of cells around it one rank
+    at a time and stops at the first one in range, so no (source, target) pair
+    list is ever built.
+    """
+    hit = np.zeros(len(dst), dtype=bool)
+    if len(src) == 0 or len(dst) == 0:
+        return hit
+    n_rows = int(height // radius) + 3
+    src_cell = np.floor(src / radius).astype(np.int64) + 1
+    dst_cell = np.floor(dst / radius).astype(np.int64) + 1
+    src_key = src_cell[:, 0] * n_rows + src_cell[:, 1]
+    order = np.argsort(src_key, kind="stable")
+    sorted_key = src_key[order]
+    sorted_src = src[order]
+    for ox, oy in ((0, 0), (-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)):
+        targets = np.flatnonzero(~hit)
+        key = (dst_cell[targets, 0] + ox) * n_rows + dst_cell[targets, 1] + oy
+        starts = np.searchsorted(sorted_key, key, "left")
+        ends = np.searchsorted(sorted_key, key, "right")
+        alive = starts < ends
+        targets, starts, ends = targets[alive], starts[alive], ends[alive]
+        while len(targets):
+            d = sorted_src[starts] - dst[targets]
+            close = np.einsum("ij,ij->i", d, d) <= radius * radius
+            hit[targets[close]] = True
+            starts += 1
+            alive = ~close & (starts < ends)
+            targets, starts, ends = targets[alive], starts[alive], ends[alive]
+    return hit
+
+
+class VectorizedVillage(mesa.Model):
+    """Array-backed variant of :class:`Village`.
+
+    Positions, roles and speeds live in NumPy arrays and every rule of the
+    object model (transformation, infection, curing, hunting, wandering) is
+    applied to the whole population at once each tick. The rules run one after
+    the other, each on the roles left by the previous one, instead of in the
+    random activation order of the agents: runs are statistically similar to
+    :class:`Village` but do not reproduce its series for a given seed.
+    """
+    p_transform = 0.1
+    wolf_distance_attack = 40
+    cleric_distance_attack = 30
+    hunter_distance_attack = 40
+
+    def __init__(self, n_villagers, n_lycanthropes, n_clerics, n_hunters, speed=10, seed=None):
+        mesa.Model.__init__(self)
+        self.space = mesa.space.ContinuousSpace(600, 600, False)
+        self.rng = np.random.default_rng(seed)
+        self.steps = 0
+        n = n_villagers + n_lycanthropes + n_clerics + n_hunters
+        self.pos = self.rng.random((n, 2)) * 600
+        self.speed = np.full(n, float(speed))
+        self.role = np.repeat(np.array([ROLE_VILLAGER, ROLE_WOLF, ROLE_CLERIC, ROLE_HUNTER], dtype=np.int8),
+                              [n_villagers, n_lycanthropes, n_clerics, n_hunters])
+
+        self.data_collector = DataCollector({"Werewolves": lambda m: m.count(ROLE_WOLF),
+                                             "Transformed": lambda m: m.count(ROLE_TRANSFORMED),
+                                             "Total": lambda m: len(m.role),
+                                             "Population": lambda m: len(m.role) - m.count(ROLE_WOLF)
+                                                                     - m.count(ROLE_TRANSFORMED)})
+
+    def count(self, role):
+        return int(np.count_nonzero(self.role == role))
+
+    @property
+    def villagers(self):
+        return np.flatnonzero(self.role == ROLE_VILLAGER)
+
+    @property
+    def wolfs(self):
+        return np.flatnonzero((self.role == ROLE_WOLF) | (self.role == ROLE_TRANSFORMED))
+
+    @property
+    def clerics(self):
+        return np.flatnonzero(self.role == ROLE_CLERIC)
+
+    @property
+    def hunters(self):
+        return np.flatnonzero(self.role == ROLE_HUNTER)
+
+    def step(self):
+        role = self.role
+        wolves = role == ROLE_WOLF
+        role[wolves & (self.rng.random(len(role)) <= self.p_transform)] = ROLE_TRANSFORMED
+
+        # Infection: any werewolf contaminates the villagers in range
+        targets = np.flatnonzero(role == ROLE_VILLAGER)
+        hit = any_within(self.pos[self.wolfs], self.pos[targets], self.wolf_distance_attack)
+        role[targets[hit]] = ROLE_WOLF
+
+        # Curing: clerics heal the untransformed werewolves in range
+        targets = np.flatnonzero(role == ROLE_WOLF)
+        hit = any_within(self.pos[self.clerics], self.pos[targets], self.cleric_distance_attack)
+        role[targets[hit]] = ROLE_VILLAGER
+
+        # Hunting: hunters kill the transformed werewolves in range
+        targets = np.flatnonzero(role == ROLE_TRANSFORMED)
+        hit = any_within(self.pos[self.hunters], self.pos[targets], self.hunter_distance_attack)
+        if hit.any():
+            alive = np.ones(len(role), dtype=bool)
+            alive[targets[hit]] = False
+            self.pos = self.pos[alive]
+            self.speed = self.speed[alive]
+            self.role = role[alive]
+
+        r = self.rng.random(len(self.role)) * math.pi * 2
+        step = np.column_stack((np.cos(r), np.sin(r))) * self.speed[:, None]
+        self.pos = np.clip(self.pos + step, (self.space.x_min, self.space.y_min),
+                           (self.space.x_max, self.space.y_max))
+
+        self.steps += 1
+        if self.steps >= 1000:
+            self.running = False
+
+
+
+BATCH_PARAMS = {"n_villagers":  [50],
+                "n_lycanthropes": [5],
+                "n_clerics": range(0, 6, 1),
+                "n_hunters": [1]}
+
+# Final counts, named apart from the BATCH_PARAMS input columns they would overwrite
+BATCH_REPORTERS = {"Villagers": lambda m: len(m.villagers),
+                   "Lycanthropes": lambda m: len(m.wolfs),
+                   "Clerics": lambda m: len(m.clerics),
+                   "Hunters": lambda m: len(m.hunters)}
+
+
+def run_seed(base_seed, combination, iteration):
+    """Deterministic, statistically independent seed for one run of a sweep."""
+    return int(np.random.SeedSequence([base_seed, combination, iteration]).generate_state(1)[0])
+
+
+def run_village(combination, iteration, params, seed, max_steps):
+    """Run one Village to completion and return its CSV row (worker side)."""
+    model = Village(seed=seed, **params)
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+    row = {"Combination": combination, "Iteration": iteration, "seed": seed}
+    row.update(params)
+    row.update({name: reporter(model) for name, reporter in BATCH_REPORTERS.items()})
+    return row
+
+
+def run_batch(path='params.csv', iterations=1, max_steps=1000, base_seed=0, max_workers=None, resume=True):
+    """Run the BATCH_PARAMS sweep over a process pool.
+
+    Every (parameter combination, iteration) pair gets a fixed seed, and each
+    row (input parameters and final counts) is appended to ``path`` as soon as
+    its run finishes. With ``resume``, the pairs already present in an existing
+    file are skipped, whatever ``iterations`` was when it was written.
+    """
+    names = list(BATCH_PARAMS)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*BATCH_PARAMS.values())]
+    runs = [(i, it, params) for i, params in enumerate(combinations) for it in range(iterations)]
+
+    fields = ["Combination", "Iteration", "seed"] + names + list(BATCH_REPORTERS)
+    done = set()
+    if resume and os.path.exists(path):
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is not None and reader.fieldnames != fields:
+                raise ValueError("cannot resume %s: its columns %s are not those of this sweep %s "
+                                 "(move it away or pass resume=False)" % (path, reader.fieldnames, fields))
+            done = {(int(row["Combination"]), int(row["Iteration"])) for row in reader}
+    with open(path, 'a' if done else 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        if not done:
+            writer.writeheader()
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(run_village, i, it, params, run_seed(base_seed, i, it), max_steps)
+                       for i, it, params in runs if (i, it) not in done]
+            for future in as_completed(futures):
+                writer.writerow(future.result())
+                f.flush()
+
+
+def run_headless(n_steps, path=None, engine="object", seed=None, **params):
+    """Run a single Village for n_steps without any visualization.
+
+    The data_collector series are sampled into a preallocated array after
+    every step (row 0 is the initial state) and written once at the end:
+    Parquet when ``path`` ends with ``.parquet`` (needs pyarrow), NPZ
+    otherwise. Returns the series as a dict of NumPy arrays.
+    """
+    if engine == "numpy":
+        model = VectorizedVillage(seed=seed, **params)
+    else:
+        model = Village(seed=seed, **params)
+    reporters = model.data_collector.model_reporters
+    values = np.zeros((n_steps + 1, len(reporters)), dtype=np.int64)
+    values[0] = [reporter(model) for reporter in reporters.values()]
+    steps = 0
+    while steps < n_steps and model.running:
+        model.step()
+        steps += 1
+        values[steps] = [reporter(model) for reporter in reporters.values()]
+    series = {"step": np.arange(steps + 1)}
+    series.update({name: values[:steps + 1, i] for i, name in enumerate(reporters)})
+
+    if path is not None:
+        if path.endswith(".parquet"):
+            pandas.DataFrame(series).to_parquet(path)
+        else:
+            np.savez(path, **series)
+    return series
+
+
 if  __name__  ==  "__main__":
-    run_batch()
+    parser = argparse.ArgumentParser(description="Village of Thierceville")
+    parser.add_argument("mode", nargs="?", default="batch", choices=["batch", "headless", "server"])
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--output", default="village.npz")
+    parser.add_argument("--engine", default="object", choices=["object", "numpy"])
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--villagers", type=int, default=50)
+    parser.add_argument("--lycanthropes", type=int, default=5)
+    parser.add_argument("--clerics", type=int, default=1)
+    parser.add_argument("--hunters", type=int, default=1)
+    args = parser.parse_args()
+    if args.mode == "batch":
+        run_batch(max_steps=args.steps)
+    elif args.mode == "headless":
+        run_headless(args.steps, args.output, args.engine, args.seed, n_villagers=args.villagers,
+                     n_lycanthropes=args.lycanthropes, n_clerics=args.clerics, n_hunters=args.hunters)
+    else:
+        from village_server import run_single_server
+        run_single_server()
@@ -0,0 +1,180 @@
+"""Interactive ModularServer front-end of the Village model.
+
+Kept apart from :mod:`village` so that batch and headless runs never import
+mesa's visualization stack nor tornado.
+"""
+from itertools import chain
+
+import numpy as np
+
+from mesa.visualization.ModularVisualization import ModularServer, VisualizationElement, UserSettableParameter
+
+from village import Village
+
+
+class ContinuousCanvas(VisualizationElement):
+    """Canvas streaming columnar frames, as deltas when few agents changed.
+
+    The portrayal of an agent is built once per agent class and
+    ``portrayal_state()`` (a template) and the positions of the agents sharing
+    a template are normalized in one NumPy pass. A frame is a list of groups,
+    one per template, holding the ids and the columns of its agents::
+
+        {"key": bool, "templates": {id: {"portrayal": {...}, "columns": ["x", "y"]}},
+         "static": [], "update": [{"template": id, "ids": [...], "columns": {"x": [...], "y": [...]}}],
+         "remove": [ids]}
+
+    When most agents changed since the previous frame (villagers move every
+    tick), the frame is a keyframe holding every group without ids. Otherwise
+    it only holds the agents that changed and the ids of the removed ones, and
+    carries the ids; a keyframe with ids is sent after an id-less one, for a
+    new model and every ``keyframe_interval`` steps.
+    """
+    local_includes = [
+        "./js/simple_continuous_canvas.js",
+    ]
+
+    def __init__(self, canvas_height=500,
+                 canvas_width=500, instantiate=True, keyframe_interval=100):
+        self.canvas_height = canvas_height
+        self.canvas_width = canvas_width
+        self.identifier = "space-canvas"
+        self.keyframe_interval = keyframe_interval
+        self.template_ids = {}
+        self.templates = []
+        self.model = None
+        self.keyframe_step = 0
+        self.sent = None  # (ids, template ids, xy) of the last frame, see rows
+        self.sent_ids = False  # whether the client knows the agents of the last frame by id
+        self.sent_templates = set()
+        if (instantiate):
+            new_element = ("new Simple_Continuous_Module({}, {},'{}')".
+                           format(self.canvas_width, self.canvas_height, self.identifier))
+            self.js_code = "elements.push(" + new_element + ");"
+
+    def portrayal_method(self, obj):
+        return obj.portrayal_method()
+
+    def template_id(self, obj):
+        key = (type(obj), obj.portrayal_state())
+        tid = self.template_ids.get(key)
+        if tid is None:
+            tid = self.template_ids[key] = len(self.templates)
+            self.templates.append({"portrayal": self.portrayal_method(obj), "columns": ["x", "y"]})
+        return tid
+
+    def rows(self, model):
+        """Agents of the model as arrays sorted by id: ids, template ids and normalized (x, y)."""
+        agents = model.schedule.agents
+        ids = np.fromiter((agent.unique_id for agent in agents), np.int64, len(agents))
+        tids = np.fromiter(map(self.template_id, agents), np.int64, len(agents))
+        xy = np.fromiter(chain.from_iterable(agent.pos for agent in agents), float, 2 * len(agents)).reshape(-1, 2)
+        xy = np.round((xy - (model.space.x_min, model.space.y_min)) / (model.space.width, model.space.height), 4)
+        order = np.argsort(ids, kind="stable")
+        return ids[order], tids[order], xy[order]
+
+    def groups(self, ids, tids, xy, with_ids):
+        """One columnar group per template id of the rows."""
+        groups = []
+        for tid in np.unique(tids).tolist():
+            sel = tids == tid
+            group = {"template": tid, "columns": {"x": xy[sel, 0].tolist(), "y": xy[sel, 1].tolist()}}
+            if with_ids:
+                group["ids"] = ids[sel].tolist()
+            groups.append(group)
+        return groups
+
+    def render(self, model):
+        if model is not self.model:
+            self.model = model
+            self.keyframe_step = model.schedule.steps
+            self.sent = None
+            self.sent_ids = False
+            self.sent_templates = set()
+        ids, tids, xy = self.rows(model)
+        if self.sent is None:
+            changed = np.ones(len(ids), dtype=bool)
+            removed = []
+        else:
+            sent_ids, sent_tids, sent_xy = self.sent
+            at = np.minimum(np.searchsorted(sent_ids, ids), max(len(sent_ids) - 1, 0))
+            if len(sent_ids):
+                changed = (sent_ids[at] != ids) | (sent_tids[at] != tids) | (sent_xy[at] != xy).any(axis=1)
+            else:
+                changed = np.ones(len(ids), dtype=bool)
+            removed = sent_ids[~np.isin(sent_ids, ids)].tolist()
+        full = 2 * (int(changed.sum()) + len(removed)) > len(ids)
+        keyframe = full or not self.sent_ids or model.schedule.steps - self.keyframe_step >= self.keyframe_interval
+        if keyframe:
+            self.keyframe_step = model.schedule.steps
+            changed[:] = True
+        frame = {"key": keyframe,
+                 "static": [],
+                 "update": self.groups(ids[changed], tids[changed], xy[changed], with_ids=not full),
+                 "remove": [] if keyframe else removed}
+        used = {group["template"] for group in frame["update"]} - self.sent_templates
+        frame["templates"] = {tid: self.templates[tid] for tid in used}
+        self.sent_templates |= used
+        self.sent = (ids, tids, xy)
+        self.sent_ids = not full
+        return frame
+
+class ChartModule(VisualizationElement):
+
+    local_includes = [
+        "./js/ChartModule.js",
+        "./js/chart.min.js"
+    ]
+
+    def __init__(
+        self,
+        series,
+        canvas_height=400,
+        canvas_width=800,
+        data_collector_name="data_collector",
+    ):
+
+        self.series = series
+        self.canvas_height = canvas_height
+        self.canvas_width = canvas_width
+        self.data_collector_name = data_collector_name
+        #series_json = json.dumps(self.series)
+        new_element = ("new ChartModule({}, {},'{}')".
+                           format(self.series, self.canvas_width, self.canvas_height))
+        self.js_code = "elements.push(" + new_element + ");"
+        
+        #new_element = "new ChartModule({}, {},  {})"
+        #new_element = new_element.format(series_json, canvas_width, canvas_height)
+        #self.js_code = "elements.push(" + new_element + ");"
+
+    
+    def render(self, model):
+        current_values = []
+        data_collector = getattr(model, self.data_collector_name)
+        data_collector.collect(model)
+        
+        for s in self.series:
+            name = s["Label"]
+            try:
+                val = data_collector.model_vars[name][-1]  # Latest value
+
+            except (IndexError, KeyError):
+                val = 0
+            current_values.append(val)
+        return current_values
+
+def run_single_server():
+    server  =  ModularServer(Village, [ContinuousCanvas(), ChartModule([{"Label": "Population", "Color": "Orange"},
+                                                                        {"Label": "Werewolves", "Color": "Red"},
+                                                                        {"Label": "Transformed", "Color": "Brown"},
+                                                                        {"Label": "Total", "Color": "black"}])],
+                                                                    "Village",{"n_villagers":  UserSettableParameter('slider', "Villagers", 20, 10, 100, 1),
+                                                                      "n_lycanthropes": UserSettableParameter('slider', "Werwolves", 5, 3, 50, 1),
+                                                                      "n_clerics": UserSettableParameter('slider', "Clerics", 1, 1, 50, 1),
+                                                                      "n_hunters": UserSettableParameter('slider', "Hunters", 2, 1, 50, 1)})
+    server.port = 8521
+    server.launch()
+
+
+if __name__ == "__main__":
+    run_single_server()
@@ -0,0 +1,58 @@
+"""Compare the contract-net JSON message bodies with contract_net_codec.
+
+Run from the TP2 directory: ``python codec_benchmark.py``
+"""
+import json
+import timeit
+
+import numpy as np
+
+import contract_net_codec as codec
+from planet_delivery import Item
+
+N = 100000
+rng = np.random.default_rng(0)
+
+
+def json_round_trip(item, destination, utility):
+    # call_for_proposal
+    body = json.dumps(item.__dict__) + '|' + str(destination.x) + '|' + str(destination.y)
+    parts = body.split('|')
+    received = Item.from_json(json.loads(parts[0]))
+    float(parts[1]), float(parts[2])
+    # proposal
+    body = json.dumps(received.__dict__) + '|' + str(utility)
+    parts = body.split('|')
+    Item.from_json(json.loads(parts[0]))
+    float(parts[1])
+    # accept_proposal / reject_proposal
+    json.loads(json.dumps(item.__dict__))
+
+
+def codec_round_trip(item, destination, utility):
+    uid, x, y, a, b, c, index = codec.decode_cfp(codec.encode_cfp(item, destination.index))
+    received = Item(x, y, a, b, c, uid)
+    codec.decode_proposal(codec.encode_proposal(received.uid, utility))
+    codec.decode_item_ref(codec.encode_item_ref(item.uid))
+
+
+class Destination:
+    def __init__(self):
+        self.x, self.y = (rng.random(2) * 600).tolist()
+        self.index = 7
+
+
+def main():
+    item = Item(*(rng.random(2) * 600).tolist(), *rng.random(3).tolist(), 1)
+    destination = Destination()
+    utility = rng.random()
+    json_body = json.dumps(item.__dict__) + '|' + str(destination.x) + '|' + str(destination.y)
+    print("CFP body size: json %d bytes, codec %d bytes"
+          % (len(json_body), len(codec.encode_cfp(item, destination.index))))
+    for name, fn in (("json", json_round_trip), ("codec", codec_round_trip)):
+        seconds = min(timeit.repeat(lambda: fn(item, destination, utility), number=N, repeat=3))
+        print("%-5s %.2f us per CFP/proposal/answer exchange" % (name, seconds / N * 1e6))
+
+
+if __name__ == "__main__":
+    main()
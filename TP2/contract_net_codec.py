@@ -0,0 +1,53 @@
+"""Compact binary encoding of the contract-net messages exchanged in planet_delivery.
+
+Every performative has a fixed struct layout, so encoding is a single pack and
+decoding a single unpack instead of building and parsing JSON. Item uids are
+split into two unsigned 64-bit words, so any id up to 128 bits fits. XMPP
+bodies must be text, hence the base64 wrapping.
+"""
+import base64
+import struct
+
+# uid (hi, lo), item x, y, a, b, c, destination planet index
+CFP = struct.Struct("<QQdddddI")
+# uid (hi, lo), utility
+PROPOSAL = struct.Struct("<QQd")
+# uid (hi, lo), used by accept_proposal and reject_proposal
+ITEM_REF = struct.Struct("<QQ")
+
+_MASK = (1 << 64) - 1
+
+
+def _split(uid):
+    return uid >> 64, uid & _MASK
+
+
+def encode_cfp(item, destination):
+    hi, lo = _split(item.uid)
+    return base64.b64encode(CFP.pack(hi, lo, item.x, item.y, item.a, item.b, item.c, destination)).decode()
+
+
+def decode_cfp(body):
+    """Return (uid, x, y, a, b, c, destination)."""
+    hi, lo, x, y, a, b, c, destination = CFP.unpack(base64.b64decode(body))
+    return (hi << 64) | lo, x, y, a, b, c, destination
+
+
+def encode_proposal(uid, utility):
+    hi, lo = _split(uid)
+    return base64.b64encode(PROPOSAL.pack(hi, lo, utility)).decode()
+
+
+def decode_proposal(body):
+    """Return (uid, utility)."""
+    hi, lo, utility = PROPOSAL.unpack(base64.b64decode(body))
+    return (hi << 64) | lo, utility
+
+
+def encode_item_ref(uid):
+    return base64.b64encode(ITEM_REF.pack(*_split(uid))).decode()
+
+
+def decode_item_ref(body):
+    hi, lo = ITEM_REF.unpack(base64.b64decode(body))
+    return (hi << 64) | lo
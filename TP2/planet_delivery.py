@@ -1,8 +1,13 @@
+import asyncio
+import csv
+import heapq
 import json  # Pour la sérialisation/désérialisation des objects
+import logging
 import math
 import random
 import string
-from collections import defaultdict
+import sys
+from collections import defaultdict, deque
 from typing import List
 
 import mesa
@@ -20,12 +25,17 @@ from mesa.visualization.ModularVisualization import VisualizationElement, Modula
 from mesa.visualization.modules import ChartModule
 from spade.behaviour import PeriodicBehaviour, OneShotBehaviour
 from spade.template import Template
-import uuid  # Génération de Unique ID
+
+import contract_net_codec as codec  # Encodage binaire des messages du contract-net
 
 NEW_ITEM_PROBA = 0.05
 PROBA_ISSUE_ROAD = 0.05
 ROAD_BRANCHING_FACTOR = 0.5
 WAITING_TIME = 3
+ROUTE_COST_PER_TICK = 0.1  # utility lost per tick of detour when bidding on or assigning an item
+PICKUP, DROP = "pickup", "drop"
+
+logger = logging.getLogger(__name__)
 
 
 class Item:
@@ -34,25 +44,14 @@ class Item:
         return Item(json_object['x'], json_object['y'], json_object['a'], json_object['b'], json_object['c'],
                     json_object['uid'])
 
-    def __init__(self, x, y, a=None, b=None, c=None, uid=None):
-        if not a:
-            self.a = random.random()
-        else:
-            self.a = a
-        if not b:
-            self.b = random.random()
-        else:
-            self.b = b
-        if not c:
-            self.c = random.random()
-        else:
-            self.c = c
+    def __init__(self, x, y, a, b, c, uid):
+        # a, b, c come from the model's generators and uid from model.next_id()
+        self.a = a
+        self.b = b
+        self.c = c
         self.x = x
         self.y = y
-        if not uid:
-            self.uid = int(uuid.uuid1())
-        else:
-            self.uid = uid
+        self.uid = uid
 
     def __eq__(self, other):
         return isinstance(other, Item) and self.uid == other.uid
@@ -60,6 +59,9 @@ class Item:
     def __hash__(self):
         return int(self.uid)
 
+    def portrayal_state(self):
+        return None
+
     @staticmethod
     def portrayal_method():
         color = "yellow"
@@ -72,62 +74,258 @@ class Item:
         return portrayal
 
 
+class ItemRegistry:
+    """All the items of a PlanetDelivery, keyed by uid.
+
+    Also holds, per planet, the items waiting for a call for proposal
+    (``pending``: uid -> destination) and the items whose proposals are being
+    collected (``awaiting``: uid -> deadline), with a heap of the deadlines so
+    that expired rounds are popped in deadline order.
+    """
+    def __init__(self):
+        self.items = dict()
+        self.pending = defaultdict(dict)
+        self.awaiting = defaultdict(dict)
+        self.deadlines = defaultdict(list)
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def add(self, item):
+        self.items[item.uid] = item
+
+    def get(self, uid):
+        return self.items.get(uid)
+
+    def remove(self, item):
+        del self.items[item.uid]
+
+    def wait_for_proposals(self, planet, uid, deadline):
+        self.awaiting[planet][uid] = deadline
+        self.counter += 1
+        heapq.heappush(self.deadlines[planet], (deadline, self.counter, uid))
+
+    def expired(self, planet, now):
+        """Pop and return the items of planet whose proposal deadline is reached."""
+        heap = self.deadlines[planet]
+        awaiting = self.awaiting[planet]
+        items = []
+        while heap and heap[0][0] <= now:
+            deadline, _, uid = heapq.heappop(heap)
+            if awaiting.get(uid) == deadline:
+                del awaiting[uid]
+                items.append(self.items[uid])
+        return items
+
+
+class Instrumentation:
+    """Per-item timeline and message statistics of a PlanetDelivery run.
+
+    Ticks are recorded for the creation of an item, its first call for proposal,
+    its award (accepted proposal or centralized assignment) and its delivery.
+    Messages are counted per performative and the mailbox depth of every agent
+    is sampled at the end of each tick. When disabled, every hook returns at once.
+    """
+    EVENTS = ("created", "cfp", "awarded", "delivered")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timeline = dict()  # uid -> {event: tick}
+        self.messages = defaultdict(int)  # performative -> messages sent
+        self.mailbox_agents = []
+        self.mailbox_depth = []  # one array per tick, aligned with mailbox_agents
+
+    def record(self, uid, event, tick):
+        if self.enabled:
+            self.timeline.setdefault(uid, {}).setdefault(event, tick)
+
+    def count(self, msgs):
+        if self.enabled:
+            for msg in msgs:
+                self.messages[msg.metadata["performative"]] += 1
+
+    def sample_mailboxes(self, agents):
+        if self.enabled:
+            if not self.mailbox_agents:
+                self.mailbox_agents = [str(a.communicator.jid) for a in agents]
+            self.mailbox_depth.append(np.array([len(a.communicator.msg_box) for a in agents]))
+
+    def latency(self, start, end):
+        """Ticks between two events, for the items that went through both."""
+        return np.array([t[end] - t[start] for t in self.timeline.values() if start in t and end in t])
+
+    def histograms(self, bins=10):
+        """numpy histograms (counts, bin edges) of the latencies and of the mailbox depths."""
+        samples = {"cfp_to_award": self.latency("cfp", "awarded"),
+                   "award_to_delivery": self.latency("awarded", "delivered"),
+                   "creation_to_delivery": self.latency("created", "delivered"),
+                   "mailbox_depth": (np.concatenate(self.mailbox_depth) if self.mailbox_depth
+                                     else np.array([]))}
+        return {name: np.histogram(values, bins=bins) for name, values in samples.items()}
+
+    def write_csv(self, path):
+        """One row per item with the tick of each event, empty when it did not happen."""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("uid",) + self.EVENTS)
+            for uid, events in self.timeline.items():
+                writer.writerow([uid] + [events.get(e, "") for e in self.EVENTS])
+
+
 class SpaceRoadNetwork(Agent):
     def __init__(self, planets: List, unique_id: int, model: Model):
         super().__init__(unique_id, model)
+        self.rng = model.spawn_rng()  # road layout and incidents
         self.initial_graph = nx.Graph()
         self.current_graph = nx.Graph()
-        self.speed_modificator = dict()
-        for i in range(len(planets)):
-            self.initial_graph.add_node(planets[i])
-            for j in range(i):
-                if random.random() < ROAD_BRANCHING_FACTOR:
-                    distance = np.linalg.norm([planets[i].x - planets[j].x, planets[i].y - planets[j].y])
-                    self.initial_graph.add_edge(planets[i], planets[j], distance=distance)
-        # Reconnect graph of the roads between planets
-        while len(list(nx.connected_components(self.initial_graph))) != 1:
-            first_element = random.choice(tuple(list(nx.connected_components(self.initial_graph))[0]))
-            second_element = random.choice(tuple(list(nx.connected_components(self.initial_graph))[1]))
-            distance = np.linalg.norm([first_element.x - second_element.x, first_element.y - second_element.y])
-            self.initial_graph.add_edge(first_element, second_element, distance=distance)
-        for e in self.initial_graph.edges:
-            self.current_graph.add_edge(e[0], e[1],
-                                        distance=nx.get_edge_attributes(self.initial_graph, 'distance')[(e[0], e[1])])
-            self.speed_modificator[e] = 1.0
-            self.speed_modificator[(e[1], e[0])] = 1.0
+        # All pairwise distances at once, then one random draw per candidate road (i > j)
+        coords = np.array([(p.x, p.y) for p in planets], dtype=float)
+        distances = np.linalg.norm(coords[:, None, :] - coords[None, :, :], axis=2)
+        rows, cols = np.tril_indices(len(planets), -1)
+        keep = self.rng.random(len(rows)) < ROAD_BRANCHING_FACTOR
+        edges = list(zip(rows[keep].tolist(), cols[keep].tolist()))
+        # Reconnect graph of the roads between planets: union-find over the drawn roads,
+        # then chain the components with one road between random members of consecutive ones
+        parent = list(range(len(planets)))
 
-    def step(self):
-        for e in [edge for edge in self.current_graph.edges]:
-            if random.random() < PROBA_ISSUE_ROAD:
-                self.speed_modificator[e] = self.speed_modificator[e] + 0.5 + (random.random() > 0.5)*0.5
-                if self.speed_modificator[e] > 1.2:
-                    self.speed_modificator[e] = self.speed_modificator[e] - 1.5
-                self.speed_modificator[(e[1], e[0])] = self.speed_modificator[e]
+        def find(a):
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
 
+        for a, b in edges:
+            parent[find(a)] = find(b)
+        components = defaultdict(list)
+        for a in range(len(planets)):
+            components[find(a)].append(a)
+        components = list(components.values())
+        for first, second in zip(components, components[1:]):
+            edges.append((first[self.rng.integers(len(first))], second[self.rng.integers(len(second))]))
 
-    def portrayal_method(self):
-        portrayals = []
-        for e in [edge for edge in self.current_graph.edges]:
-            if self.speed_modificator[e] != 0:
-                if self.speed_modificator[e] == 1:
-                    color = "green"
-                else:
-                    color = "red"
-                portrayal = {"Shape": "line",
-                             "width": 1,
-                             "Layer": 1,
-                             "Color": color,
-                             "from_x": (tuple(e)[0].x - self.model.space.x_min) /
-                                       (self.model.space.x_max - self.model.space.x_min),
-                             "from_y": (tuple(e)[0].y - self.model.space.y_min) /
-                                       (self.model.space.y_max - self.model.space.y_min),
-                             "to_x": (tuple(e)[1].x - self.model.space.x_min) /
-                                     (self.model.space.x_max - self.model.space.x_min),
-                             "to_y": (tuple(e)[1].y - self.model.space.y_min) /
-                                     (self.model.space.y_max - self.model.space.y_min)
-                             }
-                portrayals.append(portrayal)
-        return portrayals
+        self.initial_graph.add_nodes_from(planets)
+        self.initial_graph.add_edges_from((planets[a], planets[b], {'distance': float(distances[a, b]), 'id': k})
+                                          for k, (a, b) in enumerate(edges))
+        self.current_graph.add_edges_from(self.initial_graph.edges(data=True))
+        # Edge-indexed arrays: edge k joins planets[edge_nodes[k]] and is looked up by planet.index pair
+        self.planets = planets
+        self.edge_nodes = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        self.edge_ids = np.full((len(planets), len(planets)), -1, dtype=np.int64)
+        self.edge_ids[self.edge_nodes[:, 0], self.edge_nodes[:, 1]] = np.arange(len(edges))
+        self.edge_ids[self.edge_nodes[:, 1], self.edge_nodes[:, 0]] = np.arange(len(edges))
+        self.distances = distances[self.edge_nodes[:, 0], self.edge_nodes[:, 1]]
+        self.modificators = np.ones(len(edges))
+        # Travel time between two planets by planet.index, inf without an open road
+        self.times = np.full((len(planets), len(planets)), math.inf)
+        self.times[self.edge_nodes[:, 0], self.edge_nodes[:, 1]] = self.distances
+        self.times[self.edge_nodes[:, 1], self.edge_nodes[:, 0]] = self.distances
+        # Normalized from_x, from_y, to_x, to_y of every road, computed once for rendering
+        space = model.space
+        scale = np.array([space.x_max - space.x_min, space.y_max - space.y_min])
+        normalized = (coords - np.array([space.x_min, space.y_min])) / scale
+        self.geometry = np.hstack((normalized[self.edge_nodes[:, 0]], normalized[self.edge_nodes[:, 1]]))
+        # Shortest-path trees toward each destination, built lazily and repaired when roads change:
+        # destination -> (next hop index or -1, travel time or inf) arrays by planet.index
+        self.routes = {}
+
+    def modificator(self, u, v):
+        return self.modificators[self.edge_ids[u.index, v.index]]
+
+    def route_tree(self, destination):
+        if destination not in self.routes:
+            hops = np.full(len(self.planets), -1, dtype=np.int64)
+            dist = np.full(len(self.planets), math.inf)
+            dist[destination.index] = 0.0
+            self.relax_routes(hops, dist, [(0.0, destination.index)])
+            self.routes[destination] = (hops, dist)
+        return self.routes[destination]
+
+    def next_hop(self, source, destination):
+        """Next planet on the fastest route from source to destination, None if unreachable."""
+        hop = self.route_tree(destination)[0][source.index]
+        return self.planets[hop] if hop >= 0 else None
+
+    def route_length(self, source, destination):
+        """Length of the fastest route weighted by the speed modificators, inf if unreachable."""
+        return float(self.route_tree(destination)[1][source.index])
+
+    def relax_routes(self, hops, dist, heap):
+        """Dijkstra from the (travel time, planet index) entries of heap, only the nodes whose
+        travel time decreases are visited."""
+        heapq.heapify(heap)
+        while heap:
+            time, node = heapq.heappop(heap)
+            if time > dist[node]:
+                continue
+            through = time + self.times[node]
+            better = np.flatnonzero(through < dist)
+            dist[better] = through[better]
+            hops[better] = node
+            for entry in zip(dist[better].tolist(), better.tolist()):
+                heapq.heappush(heap, entry)
+
+    def update_routes(self, roads, old_times, new_times):
+        """Repair the cached trees after the travel times of roads changed, instead of rebuilding them:
+        a slower tree edge only reroutes the subtree hanging below it, a faster edge only spreads
+        the shorter times from its endpoints."""
+        a, b = self.edge_nodes[roads].T
+        slower, faster = new_times > old_times, new_times < old_times
+        for hops, dist in self.routes.values():
+            # Subtrees below the slower tree edges lose their routes, then take the best kept neighbor
+            lost = np.zeros(len(hops), dtype=bool)
+            lost[a[slower & (hops[a] == b)]] = True
+            lost[b[slower & (hops[b] == a)]] = True
+            while True:
+                below = lost | ((hops >= 0) & lost[hops])
+                if (below == lost).all():
+                    break
+                lost = below
+            heap = []
+            if lost.any():
+                hops[lost], dist[lost] = -1, math.inf
+                lost = np.flatnonzero(lost)
+                through = dist + self.times[lost]
+                best = through.argmin(axis=1)
+                time = through[np.arange(len(lost)), best]
+                found = np.isfinite(time)
+                hops[lost[found]], dist[lost[found]] = best[found], time[found]
+                heap += zip(time[found].tolist(), lost[found].tolist())
+            # Faster roads shorten the routes through them
+            for node, hop in zip(np.concatenate((a[faster], b[faster])).tolist(),
+                                 np.concatenate((b[faster], a[faster])).tolist()):
+                time = dist[hop] + self.times[node, hop]
+                if time < dist[node]:
+                    hops[node], dist[node] = hop, time
+                    heap.append((float(time), node))
+            self.relax_routes(hops, dist, heap)
+
+    def step(self):
+        hit = np.flatnonzero(self.rng.random(len(self.modificators)) < PROBA_ISSUE_ROAD)
+        if not len(hit):
+            return
+        old = self.modificators[hit]
+        new = old + 0.5 + (self.rng.random(len(hit)) > 0.5) * 0.5
+        new[new > 1.2] -= 1.5
+        self.modificators[hit] = new
+        old_times = self.times[self.edge_nodes[hit, 0], self.edge_nodes[hit, 1]]
+        new_times = np.where(new > 0, self.distances[hit] / np.where(new > 0, new, 1), math.inf)
+        self.times[self.edge_nodes[hit, 0], self.edge_nodes[hit, 1]] = new_times
+        self.times[self.edge_nodes[hit, 1], self.edge_nodes[hit, 0]] = new_times
+        if self.model.event_driven:
+            self.model.reroute(hit)
+        if self.routes:
+            self.update_routes(hit, old_times, new_times)
+
+    def road_lines(self):
+        """(colour, road ids, normalized from/to coordinates) of the open roads,
+        green at nominal speed and red when slowed down."""
+        for color, shown in (("green", self.modificators == 1),
+                             ("red", (self.modificators != 0) & (self.modificators != 1))):
+            yield color, np.flatnonzero(shown).tolist(), np.round(self.geometry[shown], 4).tolist()
 
 
 class AgentCommunicator(spade.agent.Agent):
@@ -144,7 +342,16 @@ class AgentCommunicator(spade.agent.Agent):
 
         async def run(self):
             await self.send(self.msg)
-            print("sent: " + str(self.msg) + '\n')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("sent: %s", self.msg)
+
+    class BatchSendBehaviour(OneShotBehaviour):
+        def __init__(self, msgs):
+            super().__init__()
+            self.msgs = msgs
+
+        async def run(self):
+            await asyncio.gather(*[self.send(msg) for msg in self.msgs])
 
     class RecvBehav(PeriodicBehaviour):
         async def run(self):
@@ -152,25 +359,98 @@ class AgentCommunicator(spade.agent.Agent):
             if msg:
                 self.agent.mutex.acquire()
                 self.agent.msg_box.append(msg)
-                print("received: " + str(msg))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("received: %s", msg)
                 self.agent.mutex.release()
 
     async def setup(self):
         b = self.RecvBehav(.01)
         self.add_behaviour(b, Template())
-        print(str(self.jid) + " connected")
+        logger.info("%s connected", self.jid)
+
+    def send(self, msg):
+        self.send_behaviour = AgentCommunicator.SendBehaviour(msg)
+        self.add_behaviour(self.send_behaviour)
+        self.send_behaviour.join()
+
+    def send_batch(self, msgs):
+        # Fire and forget: the behaviour runs on SPADE's loop while the Mesa step goes on
+        self.add_behaviour(AgentCommunicator.BatchSendBehaviour(msgs))
+
+    def receive_all(self):
+        self.mutex.acquire()
+        try:
+            messages = self.msg_box
+            self.msg_box = []
+        finally:
+            self.mutex.release()
+        return messages
+
+
+class MessageBus:
+    """In-process replacement of the XMPP server: one mailbox per registered jid."""
+    def __init__(self):
+        self.mailboxes = dict()
+
+    def register(self, jid):
+        self.mailboxes[jid] = deque()
+        return self.mailboxes[jid]
+
+    def post(self, msg):
+        self.mailboxes[str(msg.to)].append(msg)
+
+
+class LocalCommunicator:
+    """Same send/receive surface as AgentCommunicator, delivered through a MessageBus.
+
+    deque.append and deque.popleft are atomic, so the mailbox needs no lock.
+    """
+    def __init__(self, jid, bus: MessageBus):
+        self.jid = jid
+        self.bus = bus
+        self.msg_box = bus.register(jid)
+
+    def start(self):
+        pass
+
+    def send(self, msg):
+        self.bus.post(msg)
+
+    def send_batch(self, msgs):
+        for msg in msgs:
+            self.bus.post(msg)
+
+    def receive_all(self):
+        messages = []
+        while self.msg_box:
+            messages.append(self.msg_box.popleft())
+        return messages
 
 
 class CommunicatingAgent(Agent):
     def __init__(self, unique_id: int, model: Model, name: string):
         super().__init__(unique_id, model)
-        self.communicator = AgentCommunicator(name + "@localhost", "password-" + name)
+        if model.transport == "spade":
+            self.communicator = AgentCommunicator(name + "@localhost", "password-" + name)
+        else:
+            self.communicator = LocalCommunicator(name + "@localhost", model.bus)
         self.communicator.start()
+        self.outbox = []
 
     def send(self, msg):
-        self.communicator.send_behaviour = AgentCommunicator.SendBehaviour(msg)
-        self.communicator.add_behaviour(self.communicator.send_behaviour)
-        self.communicator.send_behaviour.join()
+        self.model.metrics.count((msg,))
+        self.communicator.send(msg)
+
+    def enqueue(self, msg):
+        """Queue msg until the next flush instead of sending it right away."""
+        self.outbox.append(msg)
+
+    def flush(self):
+        """Send every queued message of the tick in one non-blocking batch."""
+        if self.outbox:
+            self.model.metrics.count(self.outbox)
+            self.communicator.send_batch(self.outbox)
+            self.outbox = []
 
 
 class PlanetManager(CommunicatingAgent):
@@ -178,92 +458,86 @@ class PlanetManager(CommunicatingAgent):
         super().__init__(unique_id, model, name)
         self.x = x
         self.y = y
-        self.items_to_ship = {}
-        self.waiting_for_proposal = []
         self.ships = ships
-        self.start_times = dict()
         self.proposals = dict()
         self.planets = []
+        self.index = None
+        self.rng = model.spawn_rng()  # item generation
 
     def step(self):
-        if random.random() < NEW_ITEM_PROBA:
-            item = Item(self.x, self.y)
-            self.model.items.append(item)
-            self.items_to_ship[item] = random.choice(self.planets)
-        for item in self.items_to_ship:
+        registry = self.model.items
+        items_to_ship = registry.pending[self]
+        if self.rng.random() < NEW_ITEM_PROBA:
+            item = Item(self.x, self.y, *self.rng.random(3).tolist(), self.model.next_id())
+            registry.add(item)
+            items_to_ship[item.uid] = self.planets[self.rng.integers(len(self.planets))]
+            self.model.metrics.record(item.uid, "created", self.model.schedule.steps)
+        if self.model.allocation != "contract_net":
+            return  # pending items are assigned by PlanetDelivery.allocate
+        for uid, destination in items_to_ship.items():
+            item = registry.get(uid)
             cfps = [spade.message.Message(to=str(a.communicator.jid),
                                           sender=str(self.communicator.jid),
-                                          body=json.dumps(item.__dict__) + '|' +
-                                               str(self.items_to_ship[item].x) + '|' + str(self.items_to_ship[item].y),
+                                          body=codec.encode_cfp(item, destination.index),
                                           thread='CNP-' + str(item),
                                           metadata={"performative": "call_for_proposal",
                                                     "turn": str(self.model.schedule.steps)}) for
                     a in self.ships if a.x == self.x and a.y == self.y]
             for c in cfps:
-                self.send(c)
-            self.start_times[item] = self.model.schedule.steps
-            self.proposals[item] = []
-            self.waiting_for_proposal.append(item)
-        self.items_to_ship = dict()
+                self.enqueue(c)
+            self.model.metrics.record(uid, "cfp", self.model.schedule.steps)
+            self.proposals[uid] = []
+            registry.wait_for_proposals(self, uid, self.model.schedule.steps + WAITING_TIME)
+        items_to_ship.clear()
         prop_responses = []
 
-        for i in [item for item in self.waiting_for_proposal if
-                  self.model.schedule.steps - self.start_times[item] >= WAITING_TIME]:
-            if not self.proposals[i]:
-                self.items_to_ship[i] = random.choice(self.planets)
-                self.waiting_for_proposal.remove(i)
-                del self.start_times[i]
+        for i in registry.expired(self, self.model.schedule.steps):
+            proposals = self.proposals.pop(i.uid)
+            if not proposals:
+                items_to_ship[i.uid] = self.planets[self.rng.integers(len(self.planets))]
             else:
                 #accept proposal
-                best_prop = max(self.proposals[i], key=lambda p: p[1])
+                best_prop = max(proposals, key=lambda p: p[1])
                 msg = spade.message.Message(to=str(best_prop[0]),
                                             sender=str(self.communicator.jid),
-                                            body=json.dumps(i.__dict__),
+                                            body=codec.encode_item_ref(i.uid),
                                             thread='CNP-' + str(i),
                                             metadata={"performative": "accept_proposal",
                                                       "turn": str(self.model.schedule.steps)})
-                self.send(msg)
-                self.proposals[i].remove(best_prop)
-                self.waiting_for_proposal.remove(i)
-                del self.start_times[i]
-                for prop in self.proposals[i]:
+                self.enqueue(msg)
+                self.model.metrics.record(i.uid, "awarded", self.model.schedule.steps)
+                proposals.remove(best_prop)
+                for prop in proposals:
                     if prop == best_prop:
                         continue
                     prop_responses.append(spade.message.Message(to=str(prop[0]),
                                                                 sender=str(self.communicator.jid),
-                                                                body=json.dumps(i.__dict__),
+                                                                body=codec.encode_item_ref(i.uid),
                                                                 thread='CNP-' + str(i),
                                                                 metadata={"performative": "reject_proposal",
                                                                           "turn": str(self.model.schedule.steps)}))
-                del self.proposals[i]
 
         for msg in prop_responses:
-            self.send(msg)
+            self.enqueue(msg)
+        self.flush()
 
         #respond to the proposals
-        self.communicator.mutex.acquire()
-        try:
-            messages = [m for m in self.communicator.msg_box]
-            self.communicator.msg_box = []
-        finally:
-            self.communicator.mutex.release()
+        messages = self.communicator.receive_all()
 
+        waiting_for_proposal = registry.awaiting[self]
         for m in messages:
             metadata = m.metadata
             msg_type = metadata['performative']
             if msg_type == "proposal":
                 sender = m.sender
-                body = m.body.split('|')
-                item_json = json.loads(body[0])
-                item = Item.from_json(item_json)
-                util = float(body[1])
-                for itm in self.waiting_for_proposal:
-                    if itm == item:
-                        if self.model.schedule.steps - self.start_times[itm] < WAITING_TIME:
-                            self.proposals[itm].append([sender, util])
-                        break
+                uid, util = codec.decode_proposal(m.body)
+                if self.model.schedule.steps < waiting_for_proposal.get(uid, -1):
+                    self.proposals[uid].append([sender, util])
 
 
+    def portrayal_state(self):
+        return None
+
     @staticmethod
     def portrayal_method():
         color = "blue"
@@ -278,166 +552,411 @@ class PlanetManager(CommunicatingAgent):
 
 class Ship(CommunicatingAgent):
     def __init__(self, name: string, planets: List, unique_id: int, model,
-                 x, y, max_speed: float, environment):
+                 x, y, max_speed: float, environment, capacity=1):
         super().__init__(unique_id, model, name)
-        self.preference_a = random.random()
-        self.preference_b = random.random()
-        self.preference_c = random.random()
+        self.rng = model.spawn_rng()
+        self.preference_a, self.preference_b, self.preference_c = self.rng.random(3).tolist()
+        # Event-driven mode: current leg (start tick, x0, y0, dx, dy, length, speed, road id)
+        self.leg = None
+        self.arrival = None  # tick during which the leg ends, None while the road is closed
+        self.stepped = -1  # last tick during which the ship stepped
         self.planets = planets
         self.x = x
         self.y = y
         self.max_speed = max_speed
-        self.destination = None
-        self.potential_destination = None
+        self.capacity = capacity
+        self.cargo = dict()  # uid -> item on board
+        self.route = []  # planned stops: (planet, PICKUP or DROP, item uid)
+        self.proposed = dict()  # uid -> (pickup planet, destination, tick) of the pending proposals
         self.waypoint = None
         self.previous_point = [p for p in self.planets if (p.x == self.x and p.y == self.y)][0]
         self.environment = environment
-        self.item = None
+
+    def moved_tick(self):
+        """Event-driven mode: last tick whose movement is done, as in tick mode where a ship
+        that already stepped this tick stands at its moved position."""
+        now = self.model.schedule.steps
+        return now if self.stepped == now else now - 1
+
+    @property
+    def x(self):
+        if self.leg is not None:
+            return self.position_at(self.moved_tick())[0]
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+
+    @property
+    def y(self):
+        if self.leg is not None:
+            return self.position_at(self.moved_tick())[1]
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+
+    def position_at(self, tick):
+        """Event-driven mode: position at the end of tick along the current leg."""
+        start, x0, y0, dx, dy, length, speed, _ = self.leg
+        moves = tick - start + 1
+        if moves <= 0:
+            return x0, y0
+        frac = min(1.0, moves * speed / length) if length > 0 else 1.0
+        return x0 + dx * frac, y0 + dy * frac
+
+    def start_leg(self, start):
+        """Event-driven mode: head for the waypoint from tick start and schedule the arrival."""
+        dx, dy = self.waypoint.x - self._x, self.waypoint.y - self._y
+        length = math.hypot(dx, dy)
+        road = self.environment.edge_ids[self.previous_point.index, self.waypoint.index]
+        speed = self.max_speed * self.environment.modificators[road]
+        self.leg = (start, self._x, self._y, dx, dy, length, speed, road)
+        self.model.on_road[road][self] = None
+        if length == 0:
+            self.arrival = start
+        elif speed > 0:
+            self.arrival = start + math.ceil(length / speed) - 1
+        else:
+            self.arrival = None
+
+    def reroute_leg(self, now):
+        """Event-driven mode: the speed of the road changed at tick now, restart the leg from here
+        (from the next tick if the ship already moved during this one)."""
+        moved = self.moved_tick()
+        self._x, self._y = self.position_at(moved)
+        del self.model.on_road[self.leg[7]][self]
+        self.leg = None
+        self.start_leg(moved + 1)
+
+    def arrive(self, now):
+        """Event-driven mode: the ship reaches its waypoint during tick now."""
+        del self.model.on_road[self.leg[7]][self]
+        self.leg = None
+        self._x, self._y = self.waypoint.x, self.waypoint.y
+        self.carry()
+        self.reach_waypoint()
+        if self.waypoint is not None:
+            self.start_leg(now + 1)
+
+    def carry(self):
+        for item in self.cargo.values():
+            item.x = self.x
+            item.y = self.y
+
+    def reach_waypoint(self):
+        self.previous_point = self.waypoint
+        self.serve_stops()
+        if self.route:
+            self.waypoint = self.environment.next_hop(self.previous_point, self.route[0][0])
+        else:
+            self.waypoint = None
+
+    def serve_stops(self):
+        """Load and unload the items of the stops planned at the current planet."""
+        while self.route and self.route[0][0] is self.previous_point:
+            planet, action, uid = self.route.pop(0)
+            if action == PICKUP:
+                self.cargo[uid] = self.model.items.get(uid)
+            else:
+                # deliver
+                item = self.cargo.pop(uid)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("item delivered %s by %s source %s", item, self.communicator.jid, planet.communicator.jid)
+                self.model.metrics.record(uid, "delivered", self.model.schedule.steps)
+                self.model.items.remove(item)
+                self.model.computed_items_nb += 1
+
+    def load(self):
+        """Items on board, to be picked up or bid on."""
+        return len(self.cargo) + sum(1 for stop in self.route if stop[1] == PICKUP) + len(self.proposed)
+
+    def route_ticks(self, stops):
+        """Travel time in ticks to go through stops from the next planet the ship reaches."""
+        position = self.waypoint if self.waypoint is not None else self.previous_point
+        ticks = 0.0
+        for planet, _, _ in stops:
+            if planet is not position:
+                ticks += self.environment.route_length(position, planet) / self.max_speed
+                position = planet
+        return ticks
+
+    def plan_insertion(self, uid, pickup, destination):
+        """Cheapest insertion of the pickup and drop-off of an item in the route.
+
+        Returns (marginal detour in ticks, new route); the pickup always comes before the drop-off.
+        The detour is inf when the item or the current route cannot be reached.
+        """
+        base = self.route_ticks(self.route)
+        # Closed roads may make every insertion unreachable: then the stops go at the end
+        best = (math.inf, self.route + [(pickup, PICKUP, uid), (destination, DROP, uid)])
+        for i in range(len(self.route) + 1):
+            with_pickup = self.route[:i] + [(pickup, PICKUP, uid)] + self.route[i:]
+            for j in range(i + 1, len(with_pickup) + 1):
+                route = with_pickup[:j] + [(destination, DROP, uid)] + with_pickup[j:]
+                ticks = self.route_ticks(route)
+                if ticks < best[0]:
+                    best = (ticks, route)
+        if not (math.isfinite(best[0]) and math.isfinite(base)):
+            return math.inf, best[1]
+        return best[0] - base, best[1]
+
+    def assign(self, uid, pickup, destination):
+        """Commit to carry the item: insert its stops in the route."""
+        _, route = self.plan_insertion(uid, pickup, destination)
+        self.route = route
 
     def move_to(self, dest, speed):
-        movement = tuple(min(
-            (speed * (dest.x - self.x) / np.linalg.norm((dest.x - self.x, dest.y - self.y)), speed * (dest.y - self.y) /
-             np.linalg.norm((dest.x - self.x, dest.y - self.y))),
-            (dest.x - self.x, dest.y - self.y), key=lambda p: np.linalg.norm(p)))
-        self.x += movement[0]
-        self.y += movement[1]
+        distance = np.linalg.norm((dest.x - self.x, dest.y - self.y))
+        if distance <= speed:
+            # Land exactly on dest: x += dest.x - x may miss it by a rounding error and delay the arrival
+            self.x, self.y = dest.x, dest.y
+            return
+        self.x += speed * (dest.x - self.x) / distance
+        self.y += speed * (dest.y - self.y) / distance
+
+    def batching(self):
+        """Stay on the planet while proposals for its items are pending, to leave with all of them."""
+        return self.waypoint is None and any(p[0] is self.previous_point for p in self.proposed.values())
 
     def step(self):
-        if self.waypoint is None and self.destination is not None:
-            self.waypoint = nx.dijkstra_path(self.environment.current_graph,
-                                             self.previous_point, self.destination, 'distance')[1]
-        if self.waypoint is not None:
-            self.move_to(self.waypoint, self.max_speed * self.environment.speed_modificator[
-                (self.previous_point, self.waypoint)])
-            self.item.x = self.x
-            self.item.y = self.y
-            if (self.x, self.y) == (self.waypoint.x, self.waypoint.y):
-                self.previous_point = self.waypoint
-                if self.waypoint == self.destination:
-                    # deliver
-                    print("item delivered", self.item, "by", self.communicator.jid, "source", self.destination.communicator.jid)
-                    self.waypoint = None
-                    self.destination = None
-                    self.model.items.remove(self.item)
-                    self.model.computed_items_nb += 1
-                    self.item = None
-                else:
-                    self.waypoint = nx.dijkstra_path(self.environment.current_graph,
-                                                     self.previous_point, self.destination,
-                                                     'distance')[1]  # 0 is current planet
+        self.stepped = self.model.schedule.steps
+        if self.waypoint is None and self.route:
+            self.serve_stops()
+        if self.batching():
+            pass
+        elif self.model.event_driven:
+            # No movement until the scheduled arrival, only departures and arrivals happen here
+            if self.leg is not None and self.arrival is not None and self.arrival <= self.model.schedule.steps:
+                self.arrive(self.model.schedule.steps)
+            if self.waypoint is None and self.route:
+                self.waypoint = self.environment.next_hop(self.previous_point, self.route[0][0])
+                if self.waypoint is not None:
+                    self.start_leg(self.model.schedule.steps)
+                    # A leg shorter than one move ends during this very tick, as in tick mode
+                    if self.arrival == self.model.schedule.steps:
+                        self.arrive(self.model.schedule.steps)
+        else:
+            if self.waypoint is None and self.route:
+                self.waypoint = self.environment.next_hop(self.previous_point, self.route[0][0])
+            if self.waypoint is not None:
+                self.move_to(self.waypoint, self.max_speed * self.environment.modificator(
+                    self.previous_point, self.waypoint))
+                self.carry()
+                if (self.x, self.y) == (self.waypoint.x, self.waypoint.y):
+                    self.reach_waypoint()
         #handle the cfps and accept/reject proposals msgs
-        self.communicator.mutex.acquire()
-        try:
-            messages = [m for m in self.communicator.msg_box]
-            self.communicator.msg_box = []
-        finally:
-            self.communicator.mutex.release()
-
-
-        if self.destination is None:
-            for m in messages:
-                msg_type = m.metadata['performative']
-                if msg_type == "call_for_proposal" and self.potential_destination is None:
-                    body = m.body.split('|')
-                    body[1] = float(body[1])
-                    body[2] = float(body[2])
-                    item_json = json.loads(body[0])
-                    item = Item.from_json(item_json)
-
-                    for p in self.planets:
-                        if p.x == body[1] and p.y == body[2]:
-                            self.potential_destination = p
-                            break
-
-                    for itm in self.model.items:
-                        if itm == item:
-                            self.item = itm
-                            break
-
-                    util = self.utility(item)
-                    msg = spade.message.Message(to=str(m.sender),sender=str(self.communicator.jid),
-                                                body=json.dumps(item.__dict__) + '|' +str(util),
-                                                thread='CNP-' + str(item),
-                                                metadata={"performative": "proposal",
-                                                "turn": str(self.model.schedule.steps)})
-                    self.send(msg)
-                elif msg_type == "accept_proposal" and self.potential_destination is not None:
-                    self.destination = self.potential_destination
-                    self.potential_destination = None
-                    break
+        messages = self.communicator.receive_all()
 
-                elif msg_type == "reject_proposal":
-                    self.item = None
-                    self.potential_destination = None
+        # A proposal never answered (e.g. received after the deadline) must not hold capacity forever
+        for uid in [uid for uid, p in self.proposed.items() if self.model.schedule.steps - p[2] > 2 * WAITING_TIME]:
+            del self.proposed[uid]
+        for m in messages:
+            msg_type = m.metadata['performative']
+            if msg_type == "call_for_proposal" and self.load() < self.capacity:
+                uid, x, y, a, b, c, destination = codec.decode_cfp(m.body)
+                item = Item(x, y, a, b, c, uid)
+                # The item waits on the planet that sent the CFP, which the ship may have left this tick
+                pickup = self.model.planet_at[(x, y)]
+                detour, _ = self.plan_insertion(uid, pickup, self.planets[destination])
+                if math.isinf(detour):
+                    continue  # closed roads: no bid, the planet calls again if nobody answers
+                self.proposed[uid] = (pickup, self.planets[destination], self.model.schedule.steps)
+
+                util = self.utility(item) - ROUTE_COST_PER_TICK * detour
+                msg = spade.message.Message(to=str(m.sender),sender=str(self.communicator.jid),
+                                            body=codec.encode_proposal(item.uid, util),
+                                            thread='CNP-' + str(item),
+                                            metadata={"performative": "proposal",
+                                            "turn": str(self.model.schedule.steps)})
+                self.enqueue(msg)
+            elif msg_type == "accept_proposal":
+                uid = codec.decode_item_ref(m.body)
+                if uid in self.proposed:
+                    pickup, destination, _ = self.proposed.pop(uid)
+                    self.assign(uid, pickup, destination)
 
+            elif msg_type == "reject_proposal":
+                self.proposed.pop(codec.decode_item_ref(m.body), None)
+        self.flush()
 
     def utility(self, item):
         return item.a * self.preference_a + item.b * self.preference_b + item.c * self.preference_c
 
-    def portrayal_method(self):
-        portrayal = {"Shape": "arrowHead", "s": 1, "Filled": "true", "Color": "Red", "Layer": 2, 'x': self.x,
-                     'y': self.y}
+    def heading(self):
         if self.waypoint and not (self.waypoint.x == self.x and self.waypoint.y == self.y):
             if self.waypoint.y - self.y > 0:
-                portrayal['angle'] = math.acos((self.waypoint.x - self.x) /
-                                               np.linalg.norm((self.waypoint.x - self.x, self.waypoint.y - self.y)))
+                return math.acos((self.waypoint.x - self.x) /
+                                 np.linalg.norm((self.waypoint.x - self.x, self.waypoint.y - self.y)))
             else:
-                portrayal['angle'] = 2 * math.pi - math.acos((self.waypoint.x - self.x) /
-                                                             np.linalg.norm(
-                                                                 (self.waypoint.x - self.x, self.waypoint.y - self.y)))
-        else:
-            portrayal['angle'] = 0
+                return 2 * math.pi - math.acos((self.waypoint.x - self.x) /
+                                               np.linalg.norm((self.waypoint.x - self.x, self.waypoint.y - self.y)))
+        return 0
+
+    def portrayal_state(self):
+        return None
+
+    def portrayal_method(self):
+        portrayal = {"Shape": "arrowHead", "s": 1, "Filled": "true", "Color": "Red", "Layer": 2, 'x': self.x,
+                     'y': self.y, 'angle': self.heading()}
         return portrayal
 
 
 class PlanetDelivery(mesa.Model):
 
-    def __init__(self, n_planets, n_ships):
+    def __init__(self, n_planets, n_ships, transport="local", event_driven=False, allocation="contract_net",
+                 capacity=1, instrument=False, seed=None):
         mesa.Model.__init__(self)
+        # seed fixes the planets, the start of the ships, the activation order and, through
+        # spawn_rng, the roads and their incidents, the items and the ship preferences
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+        # Own scheduler stream: mesa's Model.__new__ puts one on the class, shared by every instance
+        self.random = random.Random(int(self.rng.integers(2 ** 63)))
+        self.metrics = Instrumentation(instrument)
+        # "contract_net" between planets and ships, or centralized "greedy" / "hungarian" assignment
+        self.allocation = allocation
+        self.transport = transport  # "local" in-process MessageBus or "spade" over XMPP
+        self.bus = MessageBus()
+        # Event-driven movement: ships do not move tick by tick, their arrivals are scheduled
+        self.event_driven = event_driven
+        self.on_road = defaultdict(dict)  # road id -> ships travelling on it
         self.space = mesa.space.ContinuousSpace(600, 600, False)
         self.schedule = RandomActivation(self)
-        planets = [PlanetManager("planet-" + str(i), [], int(uuid.uuid1()), self,
-                                 random.random() * 600, random.random() * 600)
+        planets = [PlanetManager("planet-" + str(i), [], self.next_id(), self, *(self.rng.random(2) * 600).tolist())
                    for i in range(n_planets)]
-        environment = SpaceRoadNetwork(planets, int(uuid.uuid1()), self)
+        for i, p in enumerate(planets):
+            p.index = i  # destination id on the wire (see contract_net_codec) and road lookups
+        environment = SpaceRoadNetwork(planets, self.next_id(), self)
+        self.environment = environment
         self.schedule.add(environment)
         ships = []
         for i in range(n_ships):
-            starting_point = random.choice(planets)
-            ship = Ship("ship-" + str(i), planets, int(uuid.uuid1()), self,
-                        starting_point.x, starting_point.y, 60, environment)
+            starting_point = planets[self.rng.integers(len(planets))]
+            ship = Ship("ship-" + str(i), planets, self.next_id(), self,
+                        starting_point.x, starting_point.y, 60, environment, capacity)
             ships.append(ship)
             self.schedule.add(ship)
+        self.ships = ships
+        self.planets = planets
+        self.planet_at = {(p.x, p.y): p for p in planets}
         for p in planets:
             p.planets = [planet for planet in planets if planet != p]
             p.ships = ships
             self.schedule.add(p)
-        self.items = []
+        self.items = ItemRegistry()
         self.computed_items_nb = 0
         self.datacollector = DataCollector(
             model_reporters={"items": lambda model: len(model.items),
-                             "Delivered": lambda model: model.computed_items_nb
+                             "Delivered": lambda model: model.computed_items_nb,
+                             "Throughput": lambda model: model.computed_items_nb / max(model.schedule.steps, 1)
                              },
             agent_reporters={})
 
+    def spawn_rng(self):
+        """Stream of one agent: road network, item generation of a planet or ship preferences."""
+        return np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+    def reroute(self, roads):
+        """Reschedule the ships travelling on roads whose speed modificator just changed."""
+        now = self.schedule.steps
+        for road in roads.tolist():
+            for ship in list(self.on_road.get(road, ())):
+                ship.reroute_leg(now)
+
+    def allocate(self):
+        """Centralized allocation: assign every pending item to an idle ship in one go.
+
+        A pair is scored with the ship's utility for the item minus ROUTE_COST_PER_TICK
+        for each tick of detour the item adds to the route of the ship.
+        """
+        pending = [(planet, uid, destination) for planet, items in self.items.pending.items()
+                   for uid, destination in items.items()]
+        idle = [ship for ship in self.ships if ship.load() < ship.capacity]
+        if not pending or not idle:
+            return
+        items = [self.items.get(uid) for _, uid, _ in pending]
+        preferences = np.array([(s.preference_a, s.preference_b, s.preference_c) for s in idle])
+        features = np.array([(i.a, i.b, i.c) for i in items])
+        ticks = np.array([[s.plan_insertion(uid, planet, destination)[0] for planet, uid, destination in pending]
+                          for s in idle])
+        score = preferences @ features.T - ROUTE_COST_PER_TICK * ticks
+        reachable = np.isfinite(score)
+        score[~reachable] = -1e9
+        if self.allocation == "hungarian":
+            from scipy.optimize import linear_sum_assignment  # optional dependency, only for this mode
+            rows, cols = linear_sum_assignment(score, maximize=True)
+        else:
+            rows, cols = [], []
+            used_ships, used_items = set(), set()
+            for flat in np.argsort(-score, axis=None).tolist():
+                r, c = divmod(flat, len(pending))
+                if r not in used_ships and c not in used_items:
+                    used_ships.add(r)
+                    used_items.add(c)
+                    rows.append(r)
+                    cols.append(c)
+                    if len(rows) == min(len(idle), len(pending)):
+                        break
+        for r, c in zip(rows, cols):
+            if not reachable[r, c]:
+                continue
+            ship, (planet, uid, destination) = idle[r], pending[c]
+            del self.items.pending[planet][uid]
+            ship.assign(uid, planet, destination)
+            self.metrics.record(uid, "awarded", self.schedule.steps)
+
     def step(self):
+        if self.allocation != "contract_net":
+            self.allocate()
         self.schedule.step()
+        self.metrics.sample_mailboxes(self.ships + self.planets)
         self.datacollector.collect(self)
         if self.schedule.steps >= 300:
             self.running = False
 
 
 class ContinuousCanvas(VisualizationElement):
+    """Canvas streaming columnar frames, as deltas when few objects changed.
+
+    The constant fields of a portrayal are built once per class and
+    ``portrayal_state()`` of the objects (a template), and the positions of
+    the objects sharing a template are normalized in one NumPy pass. A frame
+    holds one group per template with the ids and the columns of its objects::
+
+        {"key": bool, "templates": {id: {"portrayal": {...}, "columns": [...]}},
+         "static": [groups] (keyframes only),
+         "update": [{"template": id, "ids": [...], "columns": {"x": [...], "y": [...], ...}}],
+         "remove": [ids]}
+
+    A keyframe carries the static layer (planets) and every road, ship and
+    item; without ids when most of them changed since the previous frame, the
+    next frame then being a keyframe with ids. The other frames only carry the
+    roads, ships and items that were added or changed and the ids of the
+    removed ones; a keyframe is also sent for a new model and every
+    ``keyframe_interval`` steps.
+    """
     local_includes = [
         "./js/simple_continuous_canvas.js",
     ]
 
     def __init__(self, canvas_height=500,
-                 canvas_width=500, instantiate=True):
+                 canvas_width=500, instantiate=True, keyframe_interval=100):
         VisualizationElement.__init__(self)
         self.canvas_height = canvas_height
         self.canvas_width = canvas_width
         self.identifier = "space-canvas"
+        self.keyframe_interval = keyframe_interval
+        self.template_ids = {}
+        self.templates = []
+        self.model = None
+        self.keyframe_step = 0
+        self.sent = {}  # id -> row (template id, values...) of the last frame
+        self.sent_ids = False  # whether the client knows the objects of the last frame by id
+        self.sent_templates = set()
+        self.static = []
         if instantiate:
             new_element = ("new Simple_Continuous_Module({}, {},'{}')".
                            format(self.canvas_width, self.canvas_height, self.identifier))
@@ -447,28 +966,92 @@ class ContinuousCanvas(VisualizationElement):
     def portrayal_method(obj):
         return obj.portrayal_method()
 
+    def register(self, key, portrayal, columns):
+        tid = self.template_ids.get(key)
+        if tid is None:
+            tid = self.template_ids[key] = len(self.templates)
+            self.templates.append({"portrayal": {k: v for k, v in portrayal.items() if k not in columns},
+                                   "columns": list(columns)})
+        return tid
+
+    def template_id(self, obj):
+        key = (type(obj), obj.portrayal_state())
+        if key in self.template_ids:
+            return self.template_ids[key]
+        portrayal = self.portrayal_method(obj)
+        return self.register(key, portrayal, ["x", "y"] + (["angle"] if "angle" in portrayal else []))
+
+    def rows(self, model, entities):
+        """{id: (template id, x, y[, angle])} of the (id, object) pairs of entities."""
+        groups = defaultdict(list)
+        for eid, obj in entities:
+            groups[self.template_id(obj)].append((eid, obj))
+        rows = {}
+        for tid, members in groups.items():
+            objs = [obj for _, obj in members]
+            xy = np.array([(obj.x, obj.y) for obj in objs], dtype=float)
+            xy = np.round((xy - (model.space.x_min, model.space.y_min)) / (model.space.width, model.space.height), 4)
+            columns = [xy[:, 0].tolist(), xy[:, 1].tolist()]
+            if "angle" in self.templates[tid]["columns"]:
+                columns.append(np.round([obj.heading() for obj in objs], 4).tolist())
+            for (eid, _), *values in zip(members, *columns):
+                rows[eid] = (tid, *values)
+        return rows
+
+    def groups(self, rows, ids):
+        """Columnar groups, ordered by template id, of {id: (template id, values...)} rows."""
+        members = defaultdict(list)
+        for eid, row in rows.items():
+            members[row[0]].append((eid, row))
+        groups = []
+        for tid in sorted(members):
+            columns = list(zip(*(row[1:] for _, row in members[tid])))
+            group = {"template": tid, "columns": dict(zip(self.templates[tid]["columns"], map(list, columns)))}
+            if ids:
+                group["ids"] = [eid for eid, _ in members[tid]]
+            groups.append(group)
+        return groups
+
+    def road_rows(self, model):
+        rows = {}
+        for color, roads, lines in model.environment.road_lines():
+            tid = self.register(("road", color), {"Shape": "line", "width": 1, "Layer": 1, "Color": color},
+                                ("from_x", "from_y", "to_x", "to_y"))
+            for k, line in zip(roads, lines):
+                rows["e%d" % k] = (tid, *line)
+        return rows
+
     def render(self, model):
-        representation = defaultdict(list)
-        for obj in model.schedule.agents:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                if isinstance(obj, SpaceRoadNetwork):
-                    for p in portrayal:
-                        representation[p["Layer"]].append(p)
-                else:
-                    portrayal["x"] = ((obj.x - model.space.x_min) /
-                                      (model.space.x_max - model.space.x_min))
-                    portrayal["y"] = ((obj.y - model.space.y_min) /
-                                      (model.space.y_max - model.space.y_min))
-                    representation[portrayal["Layer"]].append(portrayal)
-        for obj in model.items:
-            portrayal = self.portrayal_method(obj)
-            portrayal["x"] = ((obj.x - model.space.x_min) /
-                              (model.space.x_max - model.space.x_min))
-            portrayal["y"] = ((obj.y - model.space.y_min) /
-                              (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        return representation
+        if model.event_driven:
+            for ship in model.ships:
+                if ship.leg is not None:
+                    ship.carry()
+        if model is not self.model:
+            self.model = model
+            self.keyframe_step = model.schedule.steps
+            self.sent = {}
+            self.sent_ids = False
+            self.sent_templates = set()
+            self.static = self.groups(self.rows(model, [("p%d" % p.index, p) for p in model.planets]), ids=False)
+        rows = self.road_rows(model)
+        rows.update(self.rows(model, [("s%d" % s.unique_id, s) for s in model.ships] +
+                              [("i%d" % i.uid, i) for i in model.items]))
+        changed = {eid: row for eid, row in rows.items() if self.sent.get(eid) != row}
+        removed = [eid for eid in self.sent if eid not in rows]
+        full = 2 * (len(changed) + len(removed)) > len(rows)
+        keyframe = full or not self.sent_ids or model.schedule.steps - self.keyframe_step >= self.keyframe_interval
+        frame = {"key": keyframe,
+                 "update": self.groups(rows if keyframe else changed, ids=not full),
+                 "remove": [] if keyframe else removed}
+        if keyframe:
+            self.keyframe_step = model.schedule.steps
+            frame["static"] = self.static
+        used = {group["template"] for group in frame["update"] + frame.get("static", [])} - self.sent_templates
+        frame["templates"] = {tid: self.templates[tid] for tid in used}
+        self.sent_templates |= used
+        self.sent = rows
+        self.sent_ids = not full
+        return frame
 
 
 def run_single_server():
@@ -487,10 +1070,47 @@ def run_single_server():
                                                                                     10, 3, 20, 1),
                             "n_ships": ModularVisualization.UserSettableParameter('slider',
                                                                                   "Number of spaceships",
-                                                                                  15, 3, 30, 1)})
+                                                                                  15, 3, 30, 1),
+                            "capacity": ModularVisualization.UserSettableParameter('slider',
+                                                                                   "Ship capacity",
+                                                                                   1, 1, 5, 1),
+                            "transport": ModularVisualization.UserSettableParameter('choice',
+                                                                                    "Message transport",
+                                                                                    value="local",
+                                                                                    choices=["local", "spade"])})
     server.port = 8521
     server.launch()
 
 
+def compare_allocation(n_planets=10, n_ships=15, steps=300, modes=("contract_net", "greedy", "hungarian"), seed=0):
+    """Run the same scenario (same seed) with each allocation mode and report deliveries per tick."""
+    throughput = {}
+    for mode in modes:
+        model = PlanetDelivery(n_planets, n_ships, allocation=mode, seed=seed)
+        for _ in range(steps):
+            model.step()
+        throughput[mode] = model.computed_items_nb / steps
+        print("%-12s %.3f deliveries/tick" % (mode, throughput[mode]))
+    return throughput
+
+
+def trace_run(path="trace.csv", n_planets=10, n_ships=15, steps=300, **params):
+    """Run an instrumented scenario, write the per-item CSV trace and report the histograms."""
+    model = PlanetDelivery(n_planets, n_ships, instrument=True, **params)
+    for _ in range(steps):
+        model.step()
+    model.metrics.write_csv(path)
+    print(dict(model.metrics.messages))
+    for name, (counts, edges) in model.metrics.histograms().items():
+        print(name, counts.tolist(), np.round(edges, 1).tolist())
+    return model.metrics
+
+
 if __name__ == "__main__":
-    run_single_server()
+    logging.basicConfig(level=logging.WARNING)
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare_allocation()
+    elif len(sys.argv) > 1 and sys.argv[1] == "trace":
+        trace_run(*sys.argv[2:3])
+    else:
+        run_single_server()
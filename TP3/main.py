@@ -1,13 +1,12 @@
 import enum
 import math
 import random
-import uuid
 from enum import Enum
 import matplotlib.pyplot as plt
 
 import mesa
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import mesa.space
 from mesa import Agent, Model
@@ -18,15 +17,19 @@ from mesa.visualization.modules import ChartModule
 
 MAX_ITERATION = 100
 PROBA_CHGT_ANGLE = 0.01
+CANDIDATE_HEADINGS = 32  # random headings tried at once when the current one is blocked
+MARKER_TTL = 300  # steps before a marker that was not refreshed vanishes
+MARKER_MERGE_RADIUS = 2  # a new marker closer than this to one of the same purpose refreshes it instead
+MAX_MARKERS = 500  # above this, the oldest markers are dropped
 
 
 def move(x, y, speed, angle):
     return x + speed * math.cos(angle), y + speed * math.sin(angle)
 
 
-def go_to(x, y, speed, dest_x, dest_y):
+def go_to(x, y, speed, dest_x, dest_y, rng):
     if np.linalg.norm((x - dest_x, y - dest_y)) < speed:
-        return (dest_x, dest_y), 2 * math.pi * random.random()
+        return (dest_x, dest_y), 2 * math.pi * rng.random()
     else:
         angle = math.acos((dest_x - x)/np.linalg.norm((x - dest_x, y - dest_y)))
         if dest_y < y:
@@ -34,22 +37,189 @@ def go_to(x, y, speed, dest_x, dest_y):
         return move(x, y, speed, angle), angle
 
 
+class SpatialGrid:
+    """Uniform grid bucketing objects by their (x, y) for radius queries.
+
+    Queries only visit the cells overlapping the search disc and return the
+    objects in insertion order, as a scan of the matching list would.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.cell_of = {}
+        self.order = {}
+        self.counter = 0
+
+    def _cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def add(self, obj):
+        cell = self._cell(obj.x, obj.y)
+        self.cells[cell][obj] = None
+        self.cell_of[obj] = cell
+        self.order[obj] = self.counter
+        self.counter += 1
+
+    def remove(self, obj):
+        cell = self.cell_of.pop(obj)
+        del self.order[obj]
+        bucket = self.cells[cell]
+        del bucket[obj]
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, obj):
+        """Re-bucket obj after its x, y changed."""
+        cell = self._cell(obj.x, obj.y)
+        old = self.cell_of[obj]
+        if cell != old:
+            bucket = self.cells[old]
+            del bucket[obj]
+            if not bucket:
+                del self.cells[old]
+            self.cells[cell][obj] = None
+            self.cell_of[obj] = cell
+
+    def query(self, x, y, radius):
+        cx_min, cy_min = self._cell(x - radius, y - radius)
+        cx_max, cy_max = self._cell(x + radius, y + radius)
+        found = []
+        for cx in range(cx_min, cx_max + 1):
+            for cy in range(cy_min, cy_max + 1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for obj in bucket:
+                    if math.hypot(obj.x - x, obj.y - y) <= radius:
+                        found.append(obj)
+        found.sort(key=self.order.__getitem__)
+        return found
+
+
+class EntityStore:
+    """Entities keyed by an integer handle, with a SpatialGrid for radius queries.
+
+    Iteration follows insertion order; removal by handle is O(1).
+    """
+
+    def __init__(self, cell_size):
+        self.entities = dict()
+        self.grid = SpatialGrid(cell_size)
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities.values())
+
+    def add(self, entity):
+        entity.handle = self.counter
+        self.counter += 1
+        self.entities[entity.handle] = entity
+        self.grid.add(entity)
+        return entity.handle
+
+    def remove(self, entity):
+        del self.entities[entity.handle]
+        self.grid.remove(entity)
+
+    def query(self, x, y, radius):
+        return self.grid.query(x, y, radius)
+
+
+class MarkerStore(EntityStore):
+    """Markers with time-to-live decay, merging of near-coincident markers and a size bound.
+
+    Entities are kept ordered by last refresh, so the oldest ones are at the front
+    for both expiry and eviction.
+    """
+
+    def __init__(self, cell_size, ttl=MARKER_TTL, merge_radius=MARKER_MERGE_RADIUS, max_markers=MAX_MARKERS):
+        super().__init__(cell_size)
+        self.entities = OrderedDict()
+        self.ttl = ttl
+        self.merge_radius = merge_radius
+        self.max_markers = max_markers
+        self.counts = defaultdict(int)
+
+    def add(self, marker, tick=0):
+        for other in self.grid.query(marker.x, marker.y, self.merge_radius):
+            if other.purpose == marker.purpose:
+                other.tick = tick
+                if marker.purpose == MarkerPurpose.INDICATION:
+                    other.direction = marker.direction
+                self.entities.move_to_end(other.handle)
+                return other.handle
+        marker.tick = tick
+        self.counts[marker.purpose] += 1
+        handle = super().add(marker)
+        while len(self.entities) > self.max_markers:
+            self.remove(next(iter(self.entities.values())))
+        return handle
+
+    def remove(self, marker):
+        super().remove(marker)
+        self.counts[marker.purpose] -= 1
+
+    def expire(self, tick):
+        """Drop the markers not refreshed during the last ttl steps."""
+        while self.entities:
+            oldest = next(iter(self.entities.values()))
+            if oldest.tick + self.ttl > tick:
+                break
+            self.remove(oldest)
+
+    def count(self, purpose):
+        return self.counts[purpose]
+
+
 class MarkerPurpose(Enum):
     DANGER = enum.auto(),
     INDICATION = enum.auto()
 
 
 class ContinuousCanvas(VisualizationElement):
+    """Canvas streaming columnar frames, as deltas when few objects changed.
+
+    The constant fields of a portrayal are built once per class and
+    ``portrayal_state()`` of the objects (a template), and the positions of
+    the objects sharing a template are normalized in one NumPy pass. A frame
+    holds one group per template with the ids and the columns of its objects::
+
+        {"key": bool, "templates": {id: {"portrayal": {...}, "columns": [...]}},
+         "static": [groups] (keyframes only),
+         "update": [{"template": id, "ids": [...], "columns": {"x": [...], "y": [...], ...}}],
+         "remove": [ids]}
+
+    A keyframe carries the static layers (obstacles and quicksands) and every
+    other object; without ids when most objects changed since the previous
+    frame, the next frame then being a keyframe with ids. The other frames only
+    carry the objects that were added or changed and the ids of the removed
+    ones; a keyframe is also sent for a new model and every
+    ``keyframe_interval`` steps.
+    """
     local_includes = [
         "./js/simple_continuous_canvas.js",
     ]
+    per_object = ("x", "y", "angle")  # portrayal fields sent in the columns
 
     def __init__(self, canvas_height=500,
-                 canvas_width=500, instantiate=True):
+                 canvas_width=500, instantiate=True, keyframe_interval=100):
         VisualizationElement.__init__(self)
         self.canvas_height = canvas_height
         self.canvas_width = canvas_width
         self.identifier = "space-canvas"
+        self.keyframe_interval = keyframe_interval
+        self.template_ids = {}
+        self.templates = []
+        self.model = None
+        self.keyframe_step = 0
+        self.sent = {}  # id -> row (template id, values...) of the last frame
+        self.sent_ids = False  # whether the client knows the objects of the last frame by id
+        self.sent_templates = set()
+        self.static = []
         if (instantiate):
             new_element = ("new Simple_Continuous_Module({}, {},'{}')".
                            format(self.canvas_width, self.canvas_height, self.identifier))
@@ -58,49 +228,76 @@ class ContinuousCanvas(VisualizationElement):
     def portrayal_method(self, obj):
         return obj.portrayal_method()
 
-    def render(self, model):
-        representation = defaultdict(list)
-        for obj in model.schedule.agents:
+    def template_id(self, obj):
+        key = (type(obj), obj.portrayal_state())
+        tid = self.template_ids.get(key)
+        if tid is None:
             portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.x - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.y - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        for obj in model.mines:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.x - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.y - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        for obj in model.markers:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.x - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.y - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        for obj in model.obstacles:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.x - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.y - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        for obj in model.quicksands:
-            portrayal = self.portrayal_method(obj)
-            if portrayal:
-                portrayal["x"] = ((obj.x - model.space.x_min) /
-                                  (model.space.x_max - model.space.x_min))
-                portrayal["y"] = ((obj.y - model.space.y_min) /
-                                  (model.space.y_max - model.space.y_min))
-            representation[portrayal["Layer"]].append(portrayal)
-        return representation
+            columns = ["x", "y"] + (["angle"] if "angle" in portrayal else [])
+            tid = self.template_ids[key] = len(self.templates)
+            self.templates.append({"portrayal": {k: v for k, v in portrayal.items() if k not in self.per_object},
+                                   "columns": columns})
+        return tid
+
+    def rows(self, model, entities):
+        """{id: (template id, x, y[, angle])} of the (id, object) pairs of entities."""
+        groups = defaultdict(list)
+        for eid, obj in entities:
+            groups[self.template_id(obj)].append((eid, obj))
+        rows = {}
+        for tid, members in groups.items():
+            objs = [obj for _, obj in members]
+            xy = np.array([(obj.x, obj.y) for obj in objs], dtype=float)
+            xy = np.round((xy - (model.space.x_min, model.space.y_min)) / (model.space.width, model.space.height), 4)
+            columns = [xy[:, 0].tolist(), xy[:, 1].tolist()]
+            if "angle" in self.templates[tid]["columns"]:
+                columns.append(np.round([obj.angle for obj in objs], 4).tolist())
+            for (eid, _), *values in zip(members, *columns):
+                rows[eid] = (tid, *values)
+        return rows
+
+    def groups(self, rows, ids):
+        """Columnar groups, ordered by template id, of {id: (template id, values...)} rows."""
+        members = defaultdict(list)
+        for eid, row in rows.items():
+            members[row[0]].append((eid, row))
+        groups = []
+        for tid in sorted(members):
+            columns = list(zip(*(row[1:] for _, row in members[tid])))
+            group = {"template": tid, "columns": dict(zip(self.templates[tid]["columns"], map(list, columns)))}
+            if ids:
+                group["ids"] = [eid for eid, _ in members[tid]]
+            groups.append(group)
+        return groups
+
+    def render(self, model):
+        if model is not self.model:
+            self.model = model
+            self.keyframe_step = model.schedule.steps
+            self.sent = {}
+            self.sent_ids = False
+            self.sent_templates = set()
+            self.static = self.groups(self.rows(model, [("o%d" % i, o) for i, o in enumerate(model.obstacles)] +
+                                                [("q%d" % i, q) for i, q in enumerate(model.quicksands)]), ids=False)
+        rows = self.rows(model, [("r%d" % a.unique_id, a) for a in model.schedule.agents] +
+                         [("m%d" % m.handle, m) for m in model.mines] +
+                         [("k%d" % m.handle, m) for m in model.markers])
+        changed = {eid: row for eid, row in rows.items() if self.sent.get(eid) != row}
+        removed = [eid for eid in self.sent if eid not in rows]
+        full = 2 * (len(changed) + len(removed)) > len(rows)
+        keyframe = full or not self.sent_ids or model.schedule.steps - self.keyframe_step >= self.keyframe_interval
+        frame = {"key": keyframe,
+                 "update": self.groups(rows if keyframe else changed, ids=not full),
+                 "remove": [] if keyframe else removed}
+        if keyframe:
+            self.keyframe_step = model.schedule.steps
+            frame["static"] = self.static
+        used = {group["template"] for group in frame["update"] + frame.get("static", [])} - self.sent_templates
+        frame["templates"] = {tid: self.templates[tid] for tid in used}
+        self.sent_templates |= used
+        self.sent = rows
+        self.sent_ids = not full
+        return frame
 
 
 class Obstacle:  # Environnement: obstacle infranchissable
@@ -109,6 +306,9 @@ class Obstacle:  # Environnement: obstacle infranchissable
         self.y = y
         self.r = r
 
+    def portrayal_state(self):
+        return self.r
+
     def portrayal_method(self):
         portrayal = {"Shape": "circle",
                      "Filled": "true",
@@ -124,6 +324,9 @@ class Quicksand:  # Environnement: ralentissement
         self.y = y
         self.r = r
 
+    def portrayal_state(self):
+        return self.r
+
     def portrayal_method(self):
         portrayal = {"Shape": "circle",
                      "Filled": "true",
@@ -138,6 +341,9 @@ class Mine:  # Environnement: élément à ramasser
         self.x = x
         self.y = y
 
+    def portrayal_state(self):
+        return None
+
     def portrayal_method(self):
         portrayal = {"Shape": "circle",
                      "Filled": "true",
@@ -158,6 +364,9 @@ class Marker:  # La classe pour les balises
             else:
                 raise ValueError("Direction should not be none for indication marker")
 
+    def portrayal_state(self):
+        return self.purpose
+
     def portrayal_method(self):
         portrayal = {"Shape": "circle",
                      "Filled": "true",
@@ -177,36 +386,47 @@ class Robot(Agent):  # La classe des agents
         self.sight_distance = sight_distance
         self.angle = angle
         self.counter = 0
+        self.rng = model.spawn_rng()
 
     def ChangeRandomAngle(self):
-        self.angle = random.random() * 2 * math.pi
-
-    def intersect(self, other, newx, newy):
-        return np.linalg.norm((newx - other.x,newy-other.y))<=other.speed or np.linalg.norm((self.x - other.x,self.y-other.y))<=other.speed
-
+        self.angle = self.rng.random() * 2 * math.pi
 
     def PossibleNextPosition(self, newx, newy):
-        if(newx<0 or newy<0 or newx>=500 or newy>=500):
-            return False
-        cond=True
-        for robot in self.model.schedule.agent_buffer() : 
-            if robot ==self : 
-                continue
-            if(np.linalg.norm((self.x - robot.x,self.y-robot.y))<=self.sight_distance and self.intersect(robot, newx, newy)):
-                cond=False
-                break
-        for obs in self.model.obstacles : 
-            if(np.linalg.norm((newx - obs.x,newy-obs.y))<=obs.r) : 
-                cond=False
-                break
+        return bool(self.PossibleNextPositions(np.array([newx]), np.array([newy]))[0])
+
+    def PossibleNextPositions(self, newxs, newys):
+        """One boolean per candidate position: inside the zone, out of reach of the
+        other robots in sight and outside every obstacle.
+
+        Only the candidates are tested against the other robots, so two robots
+        already within reach of each other can still move apart.
+        """
+        cond = (newxs >= 0) & (newys >= 0) & (newxs < 500) & (newys < 500)
+        robots = [robot for robot in self.model.robot_grid.query(self.x, self.y, self.sight_distance)
+                  if robot is not self]
+        if robots:
+            pos = np.array([(robot.x, robot.y) for robot in robots])
+            reach = np.array([robot.speed for robot in robots])
+            dist = np.hypot(newxs[:, None] - pos[:, 0], newys[:, None] - pos[:, 1])
+            cond &= ~(dist <= reach).any(axis=1)
+        obstacles = self.model.obstacle_xyr
+        if len(obstacles):
+            dist = np.hypot(newxs[:, None] - obstacles[:, 0], newys[:, None] - obstacles[:, 1])
+            cond &= ~(dist <= obstacles[:, 2]).any(axis=1)
         return cond
+
+    def moveTo(self, x, y):
+        self.x = x
+        self.y = y
+        self.model.robot_grid.move(self)
+
     def  putDangerMarker(self):
-        self.model.markers.append(Marker(self.x, self.y,MarkerPurpose.DANGER))
+        self.model.addMarker(Marker(self.x, self.y,MarkerPurpose.DANGER))
         
 
     def putIndicationMarkers(self, positions):
         for (x,y) in positions : 
-            self.model.markers.append(Marker(x, y,MarkerPurpose.INDICATION,self.angle))
+            self.model.addMarker(Marker(x, y,MarkerPurpose.INDICATION,self.angle))
 
     def updCounter(self):
         self.counter=self.speed//2
@@ -214,31 +434,22 @@ class Robot(Agent):  # La classe des agents
     def step(self):
         self.counter = max((self.counter-1,0))
         # Détruire les mines
-        idxToRmv = []
         indicationMarkers = []
-        for (i,mine) in enumerate(self.model.mines) : 
+        for mine in self.model.mines.query(self.x, self.y, 2e-3) :
             if(abs(self.x-mine.x)<1e-3 and abs(self.y-mine.y)<1e-3):
-                idxToRmv.append(i)
+                self.model.mines.remove(mine)
                 indicationMarkers.append((mine.x,mine.y))
                 self.updCounter()
                 
-
-        self.model.mines= [self.model.mines[i] for i in range(len(self.model.mines)) if i not in idxToRmv]
-        
-        idxToRmv = []
-        for (i,marker) in enumerate(self.model.markers) : 
+        for marker in self.model.markers.query(self.x, self.y, 2e-3) :
             if(abs(self.x-marker.x)<1e-3 and abs(self.y-marker.y)<1e-3):
-                idxToRmv.append(i)
-        self.model.markers= [self.model.markers[i] for i in range(len(self.model.markers)) if i not in idxToRmv]
-                
-
-        self.model.mines= [self.model.mines[i] for i in range(len(self.model.mines)) if i not in idxToRmv]
+                self.model.markers.remove(marker)
         
         # Diminuer la vitesse s'il trouve dans un environnement ralentissant
         speed  = self.speed
-        for ralent in self.model.quicksands : 
+        for ralent in self.model.quicksand_grid.query(self.x, self.y, self.model.max_quicksand_r) : 
             
-            if np.linalg.norm((self.x - ralent.x,self.y-ralent.y)) <=ralent.r :
+            if math.hypot(self.x - ralent.x,self.y-ralent.y) <=ralent.r :
                 speed = speed / 2 
                 self.model.quicksandsCounter += 1
                 
@@ -249,54 +460,56 @@ class Robot(Agent):  # La classe des agents
             self.updCounter()
         self.lastspeed = speed
         # changement de l'angle aléatoirement
-        if random.random() <= PROBA_CHGT_ANGLE : 
+        if self.rng.random() <= PROBA_CHGT_ANGLE : 
             self.ChangeRandomAngle()
         
         # Détecter les mines
-        for mine in  self.model.mines : 
-            if np.linalg.norm((self.x - mine.x,self.y-mine.y)) <=self.sight_distance  : 
-                (newx , newy) , angle = go_to(self.x, self.y, speed, mine.x, mine.y)
-                if self.PossibleNextPosition(newx,newy)  : 
-                    self.x = newx
-                    self.y = newy
-                    self.angle = angle 
-                    self.putIndicationMarkers(indicationMarkers)
-                    return
+        for mine in  self.model.mines.query(self.x, self.y, self.sight_distance) : 
+            (newx , newy) , angle = go_to(self.x, self.y, speed, mine.x, mine.y, self.rng)
+            if self.PossibleNextPosition(newx,newy)  : 
+                self.moveTo(newx, newy)
+                self.angle = angle 
+                self.putIndicationMarkers(indicationMarkers)
+                return
         if(self.counter>0):
             print(self.counter)
         if(self.counter==0):
-            idxToRmv = []
-            for marker in  self.model.markers : 
-                if np.linalg.norm((self.x - marker.x,self.y-marker.y)) <=self.sight_distance  : 
-                    (newx , newy) , angle = go_to(self.x, self.y, speed, marker.x, marker.y)
-                    if self.PossibleNextPosition(newx,newy)  : 
-                        if(marker.purpose==MarkerPurpose.INDICATION):
-                            self.x = newx
-                            self.y = newy
-                            r = random.random()
-                            r = int (r>0.5)
-                            if r==0:
-                                r=-1
-                            self.angle = angle + r*math.pi/2 
-                            self.angle%=math.pi
-                            self.putIndicationMarkers(indicationMarkers)
-                            return
-                        else : 
-                            self.x = newx
-                            self.y = newy
-                            self.angle = -angle
-                            while self.angle<0: 
-                                self.angle+=2*math.pi
-                            self.putIndicationMarkers(indicationMarkers)
-                            return
-        newx , newy = move(self.x, self.y, self.speed, self.angle)
-        while not self.PossibleNextPosition(newx,newy):
-            self.ChangeRandomAngle()
-            newx , newy = move(self.x, self.y, speed, self.angle)
-
-        self.x , self.y = move(self.x, self.y, speed, self.angle)
+            for marker in  self.model.markers.query(self.x, self.y, self.sight_distance) : 
+                (newx , newy) , angle = go_to(self.x, self.y, speed, marker.x, marker.y, self.rng)
+                if self.PossibleNextPosition(newx,newy)  : 
+                    if(marker.purpose==MarkerPurpose.INDICATION):
+                        self.moveTo(newx, newy)
+                        r = self.rng.random()
+                        r = int (r>0.5)
+                        if r==0:
+                            r=-1
+                        self.angle = angle + r*math.pi/2 
+                        self.angle%=math.pi
+                        self.putIndicationMarkers(indicationMarkers)
+                        return
+                    else : 
+                        self.moveTo(newx, newy)
+                        self.angle = -angle
+                        while self.angle<0: 
+                            self.angle+=2*math.pi
+                        self.putIndicationMarkers(indicationMarkers)
+                        return
+        # Le cap actuel puis des caps aléatoires, tous testés d'un coup; on garde le premier possible
+        angles = np.concatenate(([self.angle], self.rng.random(CANDIDATE_HEADINGS) * 2 * math.pi))
+        newxs = self.x + speed * np.cos(angles)
+        newys = self.y + speed * np.sin(angles)
+        possible = np.flatnonzero(self.PossibleNextPositions(newxs, newys))
+        if possible.size:
+            i = possible[0]
+            self.angle = float(angles[i])
+            self.moveTo(float(newxs[i]), float(newys[i]))
+        else:
+            self.ChangeRandomAngle()  # bloqué: on reste sur place et on retentera au prochain pas
         self.putIndicationMarkers(indicationMarkers)
          
+    def portrayal_state(self):
+        return None
+
     def portrayal_method(self):
         portrayal = {"Shape": "arrowHead", "s": 1, "Filled": "true", "Color": "Red", "Layer": 3, 'x': self.x,
                      'y': self.y, "angle": self.angle}
@@ -306,45 +519,75 @@ class Robot(Agent):  # La classe des agents
 class MinedZone(Model):
     collector = DataCollector(
         model_reporters={"Mines": lambda model: len(model.mines),
-                         "Danger markers": lambda model: len([m for m in model.markers if
-                                                          m.purpose == MarkerPurpose.DANGER]),
-                         "Indication markers": lambda model: len([m for m in model.markers if
-                                                          m.purpose == MarkerPurpose.INDICATION]),
+                         "Danger markers": lambda model: model.markers.count(MarkerPurpose.DANGER),
+                         "Indication markers": lambda model: model.markers.count(MarkerPurpose.INDICATION),
                          "Steps in quickSand": lambda model : model.quicksandsCounter,},
         agent_reporters={})
 
-    def __init__(self, n_robots, n_obstacles, n_quicksand, n_mines, speed):
+    def __init__(self, n_robots, n_obstacles, n_quicksand, n_mines, speed, seed=None):
         Model.__init__(self)
+        # seed fixes the obstacles, quicksands, mines and robot placement, the activation
+        # order and, through spawn_rng, the headings of every robot
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+        # Own scheduler stream: mesa's Model.__new__ puts one on the class, shared by every instance
+        self.random = random.Random(int(self.rng.integers(2 ** 63)))
         self.space = mesa.space.ContinuousSpace(600, 600, False)
         self.schedule = RandomActivation(self)
-        self.mines = []  # Access list of mines from robot through self.model.mines
-        self.markers = []  # Access list of markers from robot through self.model.markers (both read and write)
+        self.mines = EntityStore(2 * speed)  # Access mines from robot through self.model.mines
+        # Access markers from robot through self.model.markers (both read and write), see MarkerStore
+        self.markers = MarkerStore(2 * speed)
         self.obstacles = []  # Access list of obstacles from robot through self.model.obstacles
         self.quicksands = []  # Access list of quicksands from robot through self.model.quicksands
+        # Radius queries on the entities, the cells being about the sight distance of the robots
+        self.robot_grid = SpatialGrid(2 * speed)
         for _ in range(n_obstacles):
-            self.obstacles.append(Obstacle(random.random() * 500, random.random() * 500, 10 + 20 * random.random()))
+            self.obstacles.append(Obstacle(*(self.rng.random(2) * 500).tolist(), 10 + 20 * self.rng.random()))
         for _ in range(n_quicksand):
-            self.quicksands.append(Quicksand(random.random() * 500, random.random() * 500, 10 + 20 * random.random()))
+            self.quicksands.append(Quicksand(*(self.rng.random(2) * 500).tolist(), 10 + 20 * self.rng.random()))
+        self.max_obstacle_r = max([o.r for o in self.obstacles], default=0)
+        self.max_quicksand_r = max([o.r for o in self.quicksands], default=0)
+        self.obstacle_grid = SpatialGrid(max(self.max_obstacle_r, 1))
+        self.quicksand_grid = SpatialGrid(max(self.max_quicksand_r, 1))
+        for o in self.obstacles:
+            self.obstacle_grid.add(o)
+        self.obstacle_xyr = np.array([(o.x, o.y, o.r) for o in self.obstacles]).reshape(-1, 3)
+        for o in self.quicksands:
+            self.quicksand_grid.add(o)
         for _ in range(n_robots):
-            x, y = random.random() * 500, random.random() * 500
-            while [o for o in self.obstacles if np.linalg.norm((o.x - x, o.y - y)) < o.r] or \
-                    [o for o in self.quicksands if np.linalg.norm((o.x - x, o.y - y)) < o.r]:
-                x, y = random.random() * 500, random.random() * 500
-            self.schedule.add(
-                Robot(int(uuid.uuid1()), self, x, y, speed,
-                      2 * speed, random.random() * 2 * math.pi))
+            x, y = (self.rng.random(2) * 500).tolist()
+            while self.blocked(x, y):
+                x, y = (self.rng.random(2) * 500).tolist()
+            robot = Robot(self.next_id(), self, x, y, speed,
+                          2 * speed, self.rng.random() * 2 * math.pi)
+            self.schedule.add(robot)
+            self.robot_grid.add(robot)
         for _ in range(n_mines):
-            x, y = random.random() * 500, random.random() * 500
-            while [o for o in self.obstacles if np.linalg.norm((o.x - x, o.y - y)) < o.r] or \
-                    [o for o in self.quicksands if np.linalg.norm((o.x - x, o.y - y)) < o.r]:
-                x, y = random.random() * 500, random.random() * 500
-            self.mines.append(Mine(x, y))
+            x, y = (self.rng.random(2) * 500).tolist()
+            while self.blocked(x, y):
+                x, y = (self.rng.random(2) * 500).tolist()
+            self.mines.add(Mine(x, y))
         self.datacollector = self.collector
         self.cumulativeMines = [0]
         self.initialCountMines = len(self.mines)
         self.quicksandsCounter = 0
 
+    def blocked(self, x, y):
+        """True when (x, y) is strictly inside an obstacle or a quicksand."""
+        return any(math.hypot(o.x - x, o.y - y) < o.r
+                   for o in self.obstacle_grid.query(x, y, self.max_obstacle_r)) or \
+            any(math.hypot(o.x - x, o.y - y) < o.r
+                for o in self.quicksand_grid.query(x, y, self.max_quicksand_r))
+
+    def spawn_rng(self):
+        """Stream of one robot's headings."""
+        return np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+    def addMarker(self, marker):
+        self.markers.add(marker, self.schedule.steps)
+
     def step(self):
+        self.markers.expire(self.schedule.steps)
         self.datacollector.collect(self)
         self.schedule.step()
         self.cumulativeMines.append(self.initialCountMines-len(self.mines))